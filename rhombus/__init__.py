@@ -12,7 +12,8 @@ from pyramid.config import Configurator
 from pyramid.request import Request, RequestLocalCache
 from pyramid.authentication import AuthTktCookieHelper, AuthTktAuthenticationPolicy
 
-from pyramid.events import BeforeRender
+from pyramid.events import BeforeRender, NewRequest
+from pyramid.tweens import INGRESS
 
 import dogpile.cache
 import dogpile.cache.util
@@ -20,11 +21,15 @@ import dogpile.cache.util
 from rhombus import configkeys as ck
 from rhombus.lib.utils import cout, cerr, get_dbhandler, random_string, dbhandler_userid_func, set_func_userid
 from rhombus.lib import helpers as h
+from rhombus.lib.cache import LRUCache
+from rhombus.models import meta
 from rhombus.routes import includeme
 from rhombus.scripts import run
 
 import time
+import math
 import datetime
+import os
 import types
 
 import logging
@@ -42,7 +47,8 @@ def init_app(global_config, settings, prefix=None, dbhandler_factory=get_dbhandl
             set_initdb_func()
 
         this function MUST be called AFTER doing multiprocessing forking/init
-        and each process needs to call this function independently
+        and each process needs to call this function independently, unless
+        prepare_app() is used before forking and post_fork() is called in each process
     """
 
     # init dogpile.cache
@@ -59,6 +65,11 @@ def init_app(global_config, settings, prefix=None, dbhandler_factory=get_dbhandl
     session_expiration_time = int(settings[ck.rb_authcache_expiration_time])
     cache.configure_from_config(settings, 'dogpile.cache.')
 
+    # optional L1 identity cache, sitting in front of authcache
+    identitycache = None
+    if (maxsize := int(settings.get(ck.rb_identitycache_maxsize, 0))) > 0:
+        identitycache = LRUCache(maxsize, float(settings.get(ck.rb_identitycache_ttl, 60)))
+
     # init database
     dbh = dbhandler_factory(settings)
 
@@ -79,14 +90,14 @@ def init_app(global_config, settings, prefix=None, dbhandler_factory=get_dbhandl
     )
 
     config.set_request_factory(RhoRequest)
-    config.set_security_policy(
-        RhoSecurityPolicy(
-            AuthTktCookieHelper(secret=settings.get(ck.rb_authsecret, random_string(24)),
-                                cookie_name=settings.get(ck.rb_authcookie, 'rb_auth_tkt'),
-                                parent_domain=parent_domain),
-            authcache
-        )
+    security_policy = RhoSecurityPolicy(
+        AuthTktCookieHelper(secret=settings.get(ck.rb_authsecret, random_string(24)),
+                            cookie_name=settings.get(ck.rb_authcookie, 'rb_auth_tkt'),
+                            parent_domain=parent_domain),
+        authcache,
+        identitycache
     )
+    config.set_security_policy(security_policy)
 
     # add shortcuts to access authcache and cache from a request instance
     config.add_request_method(auth_cache_factory(authcache), 'auth_cache', reify=True)
@@ -98,6 +109,21 @@ def init_app(global_config, settings, prefix=None, dbhandler_factory=get_dbhandl
     # config.add_request_method(get_authenticated_userobj, 'get_authenticated_userobj')
 
     config.add_subscriber(add_global, BeforeRender)
+    # above all other tweens, since pyramid_tm (with tm.annotate_user) may already load
+    # the identity, and hence set the current user, before NewRequest is notified
+    config.add_tween('rhombus.request_state_tween_factory', under=INGRESS)
+
+    # send read-only requests to read replicas, if configured
+    if dbh.replica_engines:
+        config.add_subscriber(set_replica_routing, NewRequest)
+
+    # invalidate caches of this process from changes made by other processes
+    if (interval := float(settings.get(ck.rb_changefeed_interval, 0))) > 0:
+        if setup_change_feed(dbh, security_policy, interval):
+            config.add_subscriber(check_change_feed, NewRequest)
+
+    # optional per-request SQL instrumentation
+    config.include('rhombus.lib.sqlstats')
 
     config.include(includeme, prefix)
 
@@ -127,6 +153,116 @@ def init_app(global_config, settings, prefix=None, dbhandler_factory=get_dbhandl
     return config
 
 
+def prepare_app(global_config, settings, prefix=None, dbhandler_factory=get_dbhandler,
+                include=None, include_tags=None, templates=None):
+    """ initialize application before forking worker processes (eg. with gunicorn
+        preload_app), so that the expensive and immutable state is built once and shared
+        copy-on-write by all workers
+
+        this function takes the same arguments as init_app(), plus templates as list of
+        asset specs of additional Mako template directories to be precompiled, and
+        returns the committed config. Each worker process MUST call post_fork() before
+        serving any request.
+    """
+
+    config = init_app(global_config, settings, prefix, dbhandler_factory, include,
+                      include_tags)
+    config.commit()
+    warmup_app(config, templates)
+
+    # do not let worker processes inherit the connections used by warmup
+    get_dbhandler().dispose()
+
+    return config
+
+
+def warmup_app(config, templates=None):
+    """ configure all mappers, fill EK cache and compile Mako templates """
+
+    from sqlalchemy.orm import configure_mappers
+    from pyramid.interfaces import IRendererFactory
+    from pyramid.path import AssetResolver
+    from rhombus.models.ek import get_ek_cache
+    import transaction
+
+    # this also runs configure_autoupdatemixin_fields()
+    configure_mappers()
+
+    dbh = get_dbhandler()
+    with transaction.manager:
+        count = get_ek_cache().warmup(dbh.session())
+    cerr(f'[rhombus - EK cache warmed up with {count} keys]')
+
+    factory = config.registry.queryUtility(IRendererFactory, name='.mako')
+    if factory is None or factory.lookup is None:
+        return
+
+    lookup = factory.lookup
+    uris = []
+    for spec in ['rhombus:templates'] + (templates or []):
+        uris += [f'{spec}/{path}'
+                 for path in _find_templates(AssetResolver().resolve(spec).abspath())]
+    for directory in lookup.directories:
+        uris += _find_templates(directory)
+
+    compiled = 0
+    for uri in uris:
+        try:
+            lookup.get_template(uri)
+            compiled += 1
+        except Exception as err:
+            logger.warning(f'failed to precompile template {uri}: {err}')
+    cerr(f'[rhombus - {compiled} Mako templates precompiled]')
+
+
+def _find_templates(directory):
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith('.mako'):
+                yield os.path.relpath(os.path.join(root, filename), directory)
+
+
+def setup_change_feed(dbh, security_policy, interval):
+    """ configure the change feed and register the cache invalidation handlers, return
+        False if the change feed can not be used
+    """
+
+    from rhombus.models.changefeed import get_change_feed
+    from rhombus.models.datalogsink import SinkDataLogger
+
+    datalogger = meta.get_datalogger()
+    if datalogger is None or isinstance(datalogger, SinkDataLogger):
+        cerr('[rhombus - WARN: change feed requires data logger writing to the database]')
+        return False
+
+    feed = get_change_feed()
+    feed.configure(interval=interval)
+    feed.register('ek', invalidate_ek_cache)
+    feed.register('user', security_policy.invalidate_changed_users)
+    for name in ['userclass', 'group', 'usergroup', 'associatedgroup']:
+        feed.register(name, security_policy.invalidate_all_users)
+
+    # start from the newest data log, before any request or forking
+    feed.poll(dbh.engine)
+    return True
+
+
+def invalidate_ek_cache(changes):
+    from rhombus.models.ek import get_ek_cache
+    get_ek_cache().clear()
+
+
+def post_fork(*args):
+    """ to be called in each worker process right after forking, eg. in gunicorn
+        post_fork(server, worker) hook, to drop database connections inherited from the
+        parent process, so that each worker opens its own connections
+    """
+
+    dbh = get_dbhandler()
+    dbh.dispose(close=False)
+    dbh.session.remove()
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application, and only run by pserve
     """
@@ -223,12 +359,24 @@ class RhoSecurityPolicy(object):
     """ Rhombus Security Policy, which combine auth ticket cookie to obtain local cache,
         compatible for pyramid >= 2.0. This class uses a token to load the actual userinstance
         from local auth cache. The token is composed of "login|domain|login_time|random_string"
+
+        If l1_cache (an instance of LRUCache) is provided, userinstances are also kept
+        in the process memory, so that most requests do not need to query and unpickle from
+        the auth cache backend. Userinstances in l1_cache are shared within the process, and
+        hence should be treated as read-only.
+
+        Userinstances marked as stale by invalidate_users() (eg. by the change feed) are
+        rebuilt from the database once per process, and stored back to the auth cache.
     """
 
-    def __init__(self, helper, auth_cache):
+    def __init__(self, helper, auth_cache, l1_cache=None):
         self.helper = helper
         self.auth_cache = auth_cache
+        self.l1_cache = l1_cache
         self.identity_cache = RequestLocalCache(self.load_identity)
+        self._stale_all = 0.0
+        self._stale_users = LRUCache(65536)     # user_id -> time marked as stale
+        self._validated = LRUCache(65536)       # authtoken -> time (re)built or validated
 
     def load_identity(self, request):
         identity = self.helper.identify(request)
@@ -238,7 +386,7 @@ class RhoSecurityPolicy(object):
 
         authtoken = identity['userid']
         authtk_struct = self._split_authtoken(authtoken)
-        userinstance = self.auth_cache.get(authtoken)
+        userinstance = self._get_userinstance(authtoken)
 
         if (not userinstance and ck.rb_authhost in request.registry.settings
                 and authtk_struct.authhost != request.host_url):
@@ -247,7 +395,8 @@ class RhoSecurityPolicy(object):
             userinstance = self._perform_remote_login(request, authtoken,
                                                       request.registry.settings[ck.rb_authhost])
 
-        get_dbhandler().session().set_user(userinstance)
+        # store user without instantiating a database session
+        meta.set_current_user(userinstance)
         return userinstance
         # TODO: check userinstance last stamp
 
@@ -266,16 +415,81 @@ class RhoSecurityPolicy(object):
     def remember(self, request, userinstance, **kw):
         authtoken = self._generate_authtoken(userinstance)
         userinstance.authtoken = authtoken
-        self.auth_cache.set(authtoken, userinstance)
+        self._set_userinstance(authtoken, userinstance)
         return self.helper.remember(request, authtoken, **kw)
 
     def forget(self, request, **kw):
         identity = self.helper.identify(request)
         if identity is not None:
             authtoken = identity['userid']
-            self.auth_cache.delete(authtoken)
+            self._del_userinstance(authtoken)
         return self.helper.forget(request, **kw)
 
+    def cache_stats(self):
+        """ return hit/miss counters of L1 identity cache, or None if not used """
+        if self.l1_cache is None:
+            return None
+        return self.l1_cache.stats()
+
+    def invalidate_users(self, user_ids=None):
+        """ mark userinstances of user_ids, or of all users if user_ids is None, as stale """
+        now = time.monotonic()
+        if user_ids is None:
+            self._stale_all = now
+        else:
+            for user_id in user_ids:
+                self._stale_users.set(user_id, now)
+        if self.l1_cache is not None:
+            # dropping all is cheaper than scanning, the entries are refilled from auth cache
+            self.l1_cache.clear()
+
+    def invalidate_changed_users(self, changes):
+        """ change feed handler for User """
+        self.invalidate_users({object_id for object_id, action_id in changes})
+
+    def invalidate_all_users(self, changes):
+        """ change feed handler for classes that affect group or role membership """
+        self.invalidate_users()
+
+    def _get_userinstance(self, authtoken):
+        userinstance = None
+        if self.l1_cache is not None:
+            userinstance = self.l1_cache.get(authtoken)
+        if userinstance is None:
+            userinstance = self.auth_cache.get(authtoken)
+            if userinstance and self.l1_cache is not None:
+                self.l1_cache.set(authtoken, userinstance)
+        if userinstance and self._is_stale(authtoken, userinstance):
+            userinstance = self._rebuild_userinstance(authtoken, userinstance)
+        return userinstance
+
+    def _is_stale(self, authtoken, userinstance):
+        stale_at = max(self._stale_all, self._stale_users.get(userinstance.id, 0, count=False))
+        return stale_at > 0 and self._validated.get(authtoken, 0, count=False) < stale_at
+
+    def _rebuild_userinstance(self, authtoken, userinstance):
+        user = get_dbhandler().get_user(userinstance.id)
+        if user is None:
+            self._del_userinstance(authtoken)
+            return None
+        new_userinstance = user.user_instance(authhost=userinstance.authhost)
+        new_userinstance.authtoken = authtoken
+        new_userinstance.laststamp = userinstance.laststamp
+        self._set_userinstance(authtoken, new_userinstance)
+        return new_userinstance
+
+    def _set_userinstance(self, authtoken, userinstance):
+        self.auth_cache.set(authtoken, userinstance)
+        if self.l1_cache is not None:
+            self.l1_cache.set(authtoken, userinstance)
+        self._validated.set(authtoken, time.monotonic())
+
+    def _del_userinstance(self, authtoken):
+        if self.l1_cache is not None:
+            self.l1_cache.delete(authtoken)
+        self.auth_cache.delete(authtoken)
+        self._validated.delete(authtoken)
+
     def _generate_authtoken(self, userinstance):
         # use UTC timestamp to allow for different servers in different time zones
         timestamp = int(datetime.datetime.utcnow().timestamp())
@@ -342,7 +556,7 @@ class RhoSecurityPolicy(object):
             # set user
             userinstance = user.user_instance(authhost=authhost)
             userinstance.authtoken = authtoken
-            self.auth_cache.set(authtoken, userinstance)
+            self._set_userinstance(authtoken, userinstance)
             request.session.flash(
                 (
                     'success',
@@ -614,6 +828,52 @@ def confirm_token(url, token):
     return r.json()
 
 
+def reset_request_state():
+    meta.set_current_user(None)
+    meta.set_read_only(False)
+    meta.set_written(False)
+
+
+def request_state_tween_factory(handler, registry):
+    """ tween to prevent a request from inheriting the user or read-only flag of a
+        previous request in the same thread, and to clear them after the request;
+        with read replicas, a request that has written sets the sticky primary cookie
+    """
+
+    def request_state_tween(request):
+        reset_request_state()
+        try:
+            response = handler(request)
+            if meta.has_written() and meta.get_replica_engines():
+                # keep this client on primary engine, see set_replica_routing()
+                response.set_cookie(sticky_primary_cookie, '1', httponly=True,
+                                    max_age=max(math.ceil(meta.get_replica_sticky_window()), 1))
+            return response
+        finally:
+            reset_request_state()
+
+    return request_state_tween
+
+
+def check_change_feed(event):
+    """ poll the change feed, at most once every interval seconds """
+    from rhombus.models.changefeed import get_change_feed
+    get_change_feed().check(get_dbhandler().engine)
+
+
+sticky_primary_cookie = 'rhombus_sticky_primary'
+
+
+def set_replica_routing(event):
+    """ allow GET & HEAD requests to read from replica engines, unless the client has
+        written within the sticky window (in any process), writes and flushes are always
+        sent to the primary engine
+    """
+    request = event.request
+    meta.use_replicas(request.method in ('GET', 'HEAD')
+                      and sticky_primary_cookie not in request.cookies)
+
+
 def add_global(event):
     from rhombus.views.user import user_menu
     event['h'] = h
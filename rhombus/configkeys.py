@@ -7,6 +7,19 @@ rb_default_userclass = 'rhombus.default_userclass'
 
 rb_data_logger = 'rhombus.data_logger'
 
+# out-of-band data log sink, see models/datalogsink.py
+rb_datalog_sink = 'rhombus.datalog.sink'
+rb_datalog_path = 'rhombus.datalog.path'
+rb_datalog_fsync = 'rhombus.datalog.fsync'
+rb_datalog_fsync_interval = 'rhombus.datalog.fsync_interval'
+rb_datalog_queue_size = 'rhombus.datalog.queue_size'
+rb_datalog_overflow = 'rhombus.datalog.overflow'
+rb_datalog_segment_size = 'rhombus.datalog.segment_size'
+
+# poll interval in seconds of the change feed over data logs, which invalidates EK cache
+# and userinstances changed by other processes, disabled if 0
+rb_changefeed_interval = 'rhombus.changefeed.interval'
+
 # rhombus authentication settings
 
 rb_authsecret = 'rhombus.authsecret'
@@ -23,6 +36,38 @@ rb_authcache_backend = 'rhombus.authcache.backend'
 rb_authcache_arguments_filename = 'rhombus.authcache.arguments.filename'
 rb_authcache_expiration_time = 'rhombus.authcache.expiration_time'
 
+# optional process-local L1 identity cache in front of authcache,
+# enabled when maxsize > 0
+rb_identitycache_maxsize = 'rhombus.identitycache.maxsize'
+rb_identitycache_ttl = 'rhombus.identitycache.ttl'
+
+# process-wide EK cache, with version check against database at most once
+# every check_interval seconds
+rb_ekcache_maxsize = 'rhombus.ekcache.maxsize'
+rb_ekcache_check_interval = 'rhombus.ekcache.check_interval'
+
+# opt-in per-request SQL instrumentation, with warning when a statement shape is
+# executed more than repeat_threshold times in a single request
+rb_sqlstats = 'rhombus.sqlstats'
+rb_sqlstats_repeat_threshold = 'rhombus.sqlstats.repeat_threshold'
+
+# read replicas are configured with sqlalchemy.replica.<name>.url etc, and all
+# statements are sent to primary for sticky_window seconds (default 2) after the last
+# write, both by the writing process and, through a cookie, for the writing client
+rb_replica_sticky_window = 'rhombus.replica.sticky_window'
+
+# connection pool settings for primary and replica engines, size, max_overflow and
+# timeout are only used for non-SQLite databases
+rb_pool_size = 'rhombus.pool.size'
+rb_pool_max_overflow = 'rhombus.pool.max_overflow'
+rb_pool_recycle = 'rhombus.pool.recycle'
+rb_pool_pre_ping = 'rhombus.pool.pre_ping'
+rb_pool_timeout = 'rhombus.pool.timeout'
+
+# SQLite pragmas, eg. rhombus.sqlite.journal_mode = WAL, see meta.sqlite_pragmas
+# for the list of pragmas that can be set
+rb_sqlite_ = 'rhombus.sqlite.'
+
 # google auth2 settings
 
 rb_oauth2_google_client_id = 'rhombus.oauth2.google.client_id'
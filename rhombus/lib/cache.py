@@ -0,0 +1,85 @@
+
+# cache.py - in-process caching helpers
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """ LRUCache
+
+        A bounded, thread-safe, process-local least-recently-used cache with optional
+        time-to-live for each entry. This cache is intended to be used as a L1 tier in
+        front of slower (eg. dogpile.cache) regions, hence it does not pickle the values
+        and returns the same instances to all callers in the process.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """ maxsize: maximum number of entries, ttl: time-to-live in seconds or None """
+        if maxsize < 1:
+            raise ValueError('LRUCache maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            try:
+                value, expire_at = self._data[key]
+            except KeyError:
+                if count:
+                    self.misses += 1
+                return default
+            if expire_at is not None and expire_at < time.monotonic():
+                del self._data[key]
+                if count:
+                    self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expire_at = (time.monotonic() + self.ttl) if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        """ return a list of (key, value) of the unexpired entries, least recent first """
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expire_at) in self._data.items()
+                    if expire_at is None or expire_at >= now]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """ return a dictionary of cache counters """
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    hit_ratio=(self.hits / total) if total else 0.0)
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+# EOF
@@ -54,6 +54,18 @@ def init_argparser(parser=None):
     p.add_argument('--listgroup', default=False, action='store_true',
                    help='list all groups')
 
+    p.add_argument('--rebuildgroupclosure', default=False, action='store_true',
+                   help='rebuild composite group closure table from associated groups')
+
+    p.add_argument('--replaydatalog', default=False,
+                   help='import data log from a JSON-lines segment directory or SQLite file')
+
+    p.add_argument('--archivedatalog', default=False,
+                   help='move data log older than --before to compressed files in this directory')
+
+    p.add_argument('--createdatalogindexes', default=False, action='store_true',
+                   help='create data log indexes missing from databases of older versions')
+
     # ekeys
 
     p.add_argument('--listenumkey', default=False, action='store_true')
@@ -93,6 +105,9 @@ def init_argparser(parser=None):
 
     p.add_argument('--ekeygroup', default=None)
 
+    p.add_argument('--before', default='',
+                   help='date or datetime in ISO format, eg. 2020-01-01')
+
     # general options here
 
     p.add_argument('--infile', default='-')
@@ -140,6 +155,10 @@ def _main(args):
     if any((args.exportuserclass, args.exportgroups, args.exportenumkey)):
         do_rbmgr(args, settings)
 
+    elif args.replaydatalog or args.archivedatalog:
+        # data log replay & archive manage their own transaction for each segment
+        do_rbmgr(args, settings)
+
     elif not args.rollback and (args.commit or args.initdb):
         with transaction.manager:
             do_rbmgr(args, settings)
@@ -195,6 +214,18 @@ def do_rbmgr(args, settings, dbh=None):
     elif args.listgroup:
         do_listgroup(args, dbh, settings)
 
+    elif args.rebuildgroupclosure:
+        do_rebuildgroupclosure(args, dbh, settings)
+
+    elif args.replaydatalog:
+        do_replaydatalog(args, dbh, settings)
+
+    elif args.archivedatalog:
+        do_archivedatalog(args, dbh, settings)
+
+    elif args.createdatalogindexes:
+        do_createdatalogindexes(args, dbh, settings)
+
     elif args.exportuserclass:
         do_exportuserclass(args, dbh, settings)
 
@@ -325,7 +356,6 @@ def do_listenumkey(args, dbh, settings):
 def do_exportenumkey(args, dbh, settings):
 
     cerr('Exporting enumkey')
-    ekey_list = []
     ekeys = []
     if args.exportenumkey:
         for ekey_code in args.exportenumkey.split(','):
@@ -334,19 +364,25 @@ def do_exportenumkey(args, dbh, settings):
     else:
         ekeys = dbh.list_ekeys()
 
-    for ekey in ekeys:
-        ekey_list.append(ekey.as_dict())
-
-    if args.outfile != '-':
-        open(args.outfile, 'w').write(yaml.dump(ekey_list))
+    fmt = 'json' if args.outfile.endswith('.json') else 'yaml'
+    if args.outfile == '-':
+        dbh.EK.dump(sys.stdout, ekeys, dbh.session(), format=fmt)
+    else:
+        with open(args.outfile, 'w') as outstream:
+            dbh.EK.dump(outstream, ekeys, dbh.session(), format=fmt)
+        cerr(f'[Exported enumkey to {args.outfile}]')
 
 
 def do_importenumkey(args, dbh, settings):
 
     cerr('Importing enumkey')
-    ekeys = yaml.load(open(args.infile))
-    for ek_data in ekeys:
-        dbh.EK.from_dict(ek_data, False, dbh.session())
+    ek_list = []
+    with open(args.infile) as instream:
+        for doc in yaml.safe_load_all(instream):
+            # older exports hold all trees as a single list
+            ek_list.extend(doc if type(doc) == list else [doc])
+    inserted, updated = dbh.EK.bulk_upsert(ek_list, dbh.session(), update=True)
+    cerr(f'[Imported enumkey: {inserted} inserted, {updated} updated]')
 
 
 def do_importgroup(args, dbh, settings):
@@ -384,6 +420,48 @@ def do_listgroup(args, dbh, settings):
         cout(f' {g.name}')
 
 
+def do_rebuildgroupclosure(args, dbh, settings):
+
+    from rhombus.models.user import GroupClosure
+    # the table might not exist yet in databases created by older versions
+    GroupClosure.__table__.create(bind=dbh.engine, checkfirst=True)
+    count = GroupClosure.rebuild(dbh.session())
+    cerr(f'[Rebuilt group closure table with {count} row(s)]')
+
+
+def do_replaydatalog(args, dbh, settings):
+
+    from rhombus.models.datalogsink import replay_datalog
+    commit = args.commit and not args.rollback
+    count = replay_datalog(args.replaydatalog, dbh.session(), commit=commit)
+    if commit:
+        cerr(f'[Imported {count} data log record(s)]')
+    else:
+        cerr(f'[Found {count} data log record(s), use --commit to import]')
+
+
+def do_archivedatalog(args, dbh, settings):
+
+    import datetime
+    from rhombus.models.core import DataLog
+    if not args.before:
+        cexit('ERR - please provide --before')
+    before = datetime.datetime.fromisoformat(args.before)
+    commit = args.commit and not args.rollback
+    count = DataLog.archive(dbh.session(), before, args.archivedatalog, commit=commit)
+    if commit:
+        cerr(f'[Archived {count} data log record(s) to {args.archivedatalog}]')
+    else:
+        cerr(f'[Found {count} data log record(s) before {before}, use --commit to archive]')
+
+
+def do_createdatalogindexes(args, dbh, settings):
+
+    from rhombus.models.core import DataLog
+    DataLog.create_indexes(dbh.engine)
+    cerr('[Created data log indexes]')
+
+
 def do_exporteks(args, dbh, settings):
     yaml_write(
         args,
@@ -0,0 +1,134 @@
+
+# sqlstats.py - per-request SQL instrumentation
+#
+# enable by adding the following in the config file:
+#
+#   rhombus.sqlstats = true
+#   rhombus.sqlstats.repeat_threshold = 10
+#
+# each request will then have Server-Timing header containing the number of queries
+# and the total time spent in the database, a log line of the same information, and
+# a warning if the same statement shape is executed more than repeat_threshold times
+# within a single request (which usually indicates a N+1 query pattern)
+
+import collections
+import logging
+import re
+import threading
+import time
+
+from pyramid.settings import asbool
+from sqlalchemy import event
+
+from rhombus import configkeys as ck
+from rhombus.lib.utils import get_dbhandler
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_installed_engines = set()
+
+# collapse expanding IN parameter lists and whitespaces so that statements that only
+# differ in number of bound parameters have the same shape
+_re_paramlist = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)')
+_re_spaces = re.compile(r'\s+')
+
+
+class SQLStats(object):
+    """ SQLStats
+
+        Counters of SQL statements executed in the current thread, collected by the
+        cursor execution events of the instrumented engines.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = collections.Counter()
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """ return list of (shape, count) of statements executed more than threshold times """
+        return [(shape, n) for shape, n in self.shapes.most_common() if n > threshold]
+
+
+def statement_shape(statement):
+    return _re_spaces.sub(' ', _re_paramlist.sub('(?)', statement)).strip()
+
+
+def get_stats():
+    """ return SQLStats of current thread, or None if not collecting """
+    return getattr(_local, 'stats', None)
+
+
+def start_stats():
+    _local.stats = stats = SQLStats()
+    return stats
+
+
+def stop_stats():
+    stats = get_stats()
+    _local.stats = None
+    return stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sqlstats_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get('sqlstats_start_time')
+    if not start_times:
+        return
+    start_time = start_times.pop()
+    if (stats := get_stats()) is not None:
+        stats.add(statement, time.perf_counter() - start_time)
+
+
+def install(engine):
+    """ install cursor execution listeners to engine, only once per engine """
+    if engine in _installed_engines:
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _installed_engines.add(engine)
+
+
+def sqlstats_tween_factory(handler, registry):
+    """ tween to collect SQL statistics of each request """
+
+    threshold = int(registry.settings.get(ck.rb_sqlstats_repeat_threshold, 10))
+    dbh = get_dbhandler()
+    for engine in [dbh.engine] + dbh.replica_engines:
+        install(engine)
+
+    def sqlstats_tween(request):
+        stats = start_stats()
+        try:
+            response = handler(request)
+        finally:
+            stop_stats()
+
+        duration = stats.duration * 1000
+        response.headers.add('Server-Timing',
+                             f'db;dur={duration:.1f};desc="{stats.count} queries"')
+        log.info(f'{request.method} {request.path} - {stats.count} queries, '
+                 f'{duration:.1f} ms in database')
+        for shape, n in stats.repeated(threshold):
+            log.warning(f'{request.method} {request.path} - statement executed {n} times '
+                        f'(possible N+1 queries): {shape[:200]}')
+
+        return response
+
+    return sqlstats_tween
+
+
+def includeme(config):
+    if asbool(config.get_settings().get(ck.rb_sqlstats, False)):
+        config.add_tween('rhombus.lib.sqlstats.sqlstats_tween_factory')
+
+# EOF
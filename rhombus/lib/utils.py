@@ -121,7 +121,8 @@ def generic_userid_func():
 
 
 def dbhandler_userid_func():
-    if (user := get_dbhandler().session().user):
+    from rhombus.models.meta import get_current_user
+    if (user := get_current_user()):
         return user.id
     return None
 
@@ -1,10 +1,13 @@
 
 from .core import (Base, Column, types, Identity, ForeignKey, relationship, UniqueConstraint,
-                   current_timestamp, dbsession)
+                   Index, current_timestamp, dbsession, select)
 from .ek import EK
-from .user import User, Group
+from .user import User, UserClass, UserGroup
 from rhombus.lib.utils import get_userid
 
+from sqlalchemy import literal, exists
+from sqlalchemy.orm import object_session, contains_eager
+
 from datetime import datetime
 import json
 
@@ -21,9 +24,39 @@ class ActionLog(Base):
     objs = Column(types.String(128), nullable=False, server_default='')
     stamp = Column(types.TIMESTAMP, nullable=False, default=current_timestamp())
 
-    def message(self):
-        fmt_objects = json.loads(self.objs)
-        return str(User.get(self.user_id)) + (EK.get(self.action_id).desc[2:] % fmt_objects)
+    def message(self, dbsession=None):
+        return ActionLog.messages([self], dbsession or object_session(self))[0]
+
+    @staticmethod
+    def messages(actionlogs, dbsession):
+        """ return list of messages of actionlogs, fetching the users and the action EKs
+            of all actionlogs with one query each
+        """
+        user_ids = {a.user_id for a in actionlogs}
+        action_ids = {a.action_id for a in actionlogs}
+        users = {
+            id: f'{login}/{domain}' for id, login, domain in dbsession.execute(
+                select(User.id, User.login, UserClass.domain).join(User.userclass)
+                .where(User.id.in_(user_ids)))
+        } if user_ids else {}
+        descs = dict(dbsession.execute(
+            select(EK.id, EK.desc).where(EK.id.in_(action_ids))).all()) if action_ids else {}
+
+        return [users.get(a.user_id, '') + ActionLog._format_action(descs.get(a.action_id), a)
+                for a in actionlogs]
+
+    @staticmethod
+    def _format_action(desc, actionlog):
+        """ format action description with the objects of actionlog, falling back to the
+            action id and the objects when the action EK is missing or does not match
+        """
+        objs = tuple(json.loads(actionlog.objs or '[]'))
+        if desc:
+            try:
+                return desc[2:] % objs
+            except (TypeError, ValueError):
+                pass
+        return f' action #{actionlog.action_id} on {", ".join(str(o) for o in objs)}'
 
     def timestamp(self):
         current_time = datetime.now()
@@ -44,7 +77,7 @@ class ActionLog(Base):
             return '%d second(s) ago' % delta_time.seconds
 
     @staticmethod
-    def add(action_id, *args, **kwargs):
+    def add(action_id, *args, dbsession=dbsession, **kwargs):
         actionlog = ActionLog()
         actionlog.action_id = action_id
         actionlog.objs = json.dumps(args)
@@ -56,19 +89,22 @@ class ActionLog(Base):
         for k in kwargs:
             if k == 'affected_user_id':
                 actionlog.status = 'U'
-                UserActionLog.add(user_id=get_userid(), actionlog_id=actionlog.id)
+                UserActionLog.add(user_id=get_userid(), actionlog_id=actionlog.id,
+                                  dbsession=dbsession)
                 if get_userid() != kwargs[k]:
-                    UserActionLog.add(user_id=kwargs[k], actionlog_id=actionlog.id)
+                    UserActionLog.add(user_id=kwargs[k], actionlog_id=actionlog.id,
+                                      dbsession=dbsession)
 
             elif k == 'affected_group_id':
-                group = Group.get(kwargs[k])
-                for u in group.users:
-                    UserActionLog.add(user_id=u.id, actionlog_id=actionlog.id)
+                UserActionLog.add_group(group_id=kwargs[k], actionlog_id=actionlog.id,
+                                        dbsession=dbsession)
                 actionlog.status = 'U'
 
             else:
                 raise RuntimeError('ActionLog.add(): unregconized keyword arguments %s' % k)
 
+        return actionlog
+
 
 class UserActionLog(Base):
     """ User-targetted Action Log """
@@ -79,7 +115,10 @@ class UserActionLog(Base):
     actionlog_id = Column(types.Integer, ForeignKey('actionlogs.id'), nullable=False)
     stamp = Column(types.TIMESTAMP, nullable=False, default=current_timestamp())
 
-    __table_args__ = (UniqueConstraint('user_id', 'actionlog_id'), {})
+    # the feed of a user is scanned backward by id
+    __table_args__ = (UniqueConstraint('user_id', 'actionlog_id'),
+                      Index('ix_useractionlogs_user_id_id', 'user_id', 'id'),
+                      {})
 
     actionlog = relationship(ActionLog, uselist=False)
 
@@ -90,7 +129,40 @@ class UserActionLog(Base):
         return self.actionlog.timestamp()
 
     @staticmethod
-    def add(user_id, actionlog_id):
+    def add(user_id, actionlog_id, dbsession=dbsession):
         dbsession.add(UserActionLog(user_id=user_id, actionlog_id=actionlog_id))
 
+    @staticmethod
+    def add_group(group_id, actionlog_id, dbsession=dbsession):
+        """ add actionlog to all members of group with a single INSERT ... SELECT, skipping
+            members who already have the actionlog
+        """
+        # pending UserActionLog (eg. of the affected user) must be visible to NOT EXISTS
+        dbsession.flush()
+        t = UserActionLog.__table__
+        dbsession.execute(t.insert().from_select(
+            ['user_id', 'actionlog_id'],
+            select(UserGroup.user_id, literal(actionlog_id)).where(
+                UserGroup.group_id == group_id,
+                ~exists().where(t.c.user_id == UserGroup.user_id,
+                                t.c.actionlog_id == actionlog_id))
+        ))
+
+    @staticmethod
+    def feed(user_id, dbsession, limit=20, before_id=None):
+        """ return UserActionLogs of user, newest first, with their actionlogs loaded.
+            Use the id of the last returned UserActionLog as before_id to get the next page.
+        """
+        q = select(UserActionLog).join(UserActionLog.actionlog).options(
+            contains_eager(UserActionLog.actionlog)).where(UserActionLog.user_id == user_id)
+        if before_id is not None:
+            q = q.where(UserActionLog.id < before_id)
+        return dbsession.scalars(q.order_by(UserActionLog.id.desc()).limit(limit)).all()
+
+    @staticmethod
+    def feed_messages(useractionlogs, dbsession):
+        """ return list of (useractionlog, message) """
+        return list(zip(useractionlogs,
+                        ActionLog.messages([u.actionlog for u in useractionlogs], dbsession)))
+
 # EOF
@@ -0,0 +1,137 @@
+
+# changefeed.py - change feed over data logs for cross-process cache invalidation
+#
+# every process (or node) polls datalogs table for rows newer than the last seen id, at
+# most once every interval seconds, and calls the handlers registered for the classes of
+# the changed objects, eg. to clear the EK cache or to rebuild stale userinstances.
+#
+# enable by adding the following in the config file, which requires the data logger
+# writing to the database (ie. rhombus.datalog.sink = db):
+#
+#   rhombus.data_logger = true
+#   rhombus.changefeed.interval = 5
+
+import logging
+import threading
+import time
+
+from sqlalchemy import select, func, or_
+
+from .core import DataLog, get_clsreg
+
+log = logging.getLogger(__name__)
+
+
+def changes_since(conn, last_id, limit=10000, ids=None):
+    """ return list of (id, class_id, object_id, action_id) of data logs newer than
+        last_id, plus those whose id is in ids, ordered by id
+    """
+    t = DataLog.__table__
+    criterion = t.c.id > last_id
+    if ids:
+        criterion = or_(criterion, t.c.id.in_(list(ids)))
+    return conn.execute(
+        select(t.c.id, t.c.class_id, t.c.object_id, t.c.action_id)
+        .where(criterion).order_by(t.c.id).limit(limit)
+    ).all()
+
+
+def latest_change_id(conn):
+    """ return the id of the newest data log, or 0 if there is none """
+    return conn.execute(select(func.max(DataLog.__table__.c.id))).scalar() or 0
+
+
+class ChangeFeed(object):
+    """ ChangeFeed
+
+        Polls data logs newer than the last seen id and dispatches them to the handlers
+        registered for each class name, as handler(changes) with changes being a list of
+        (object_id, action_id). The first poll only records the newest id.
+
+        Since data log ids are assigned at insert but become visible at commit, a
+        transaction might commit a lower id after a higher one has been seen. Such
+        missing ids are re-checked on subsequent polls for gap_timeout seconds.
+    """
+
+    def __init__(self, interval=5.0, limit=10000, gap_timeout=60.0):
+        self.configure(interval, limit, gap_timeout)
+        self._handlers = {}
+
+    def configure(self, interval=5.0, limit=10000, gap_timeout=60.0):
+        self.interval = interval
+        self.limit = limit
+        self.gap_timeout = gap_timeout
+        self.last_id = None
+        self._gaps = {}         # id -> time first missed
+        self._lock = threading.Lock()
+        self._checked_at = None
+
+    def register(self, target, handler):
+        """ register handler for a class or a class name """
+        name = target.lower() if isinstance(target, str) else target.lowername()
+        handlers = self._handlers.setdefault(name, [])
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def check(self, engine):
+        """ poll if the last poll was more than interval seconds ago, and no other thread
+            is polling
+        """
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            self.poll(engine)
+        except Exception:
+            log.exception('failed to poll change feed')
+        finally:
+            self._lock.release()
+
+    def poll(self, engine):
+        """ fetch new data logs and dispatch them, return the number of data logs """
+
+        with engine.connect() as conn:
+            if self.last_id is None:
+                self.last_id = latest_change_id(conn)
+                return 0
+            rows = changes_since(conn, self.last_id, self.limit, self._gaps.keys())
+
+        now = time.monotonic()
+        for row in rows:
+            if row.id in self._gaps:
+                del self._gaps[row.id]
+            elif row.id > self.last_id:
+                if row.id - self.last_id <= self.limit:
+                    self._gaps.update((i, now) for i in range(self.last_id + 1, row.id))
+                self.last_id = row.id
+        self._gaps = {i: t for i, t in self._gaps.items() if now - t < self.gap_timeout}
+
+        clsreg = get_clsreg()
+        changes = {}
+        for row in rows:
+            try:
+                name = clsreg.get_class(row.class_id).lowername()
+            except KeyError:
+                continue
+            changes.setdefault(name, []).append((row.object_id, row.action_id))
+
+        for name, class_changes in changes.items():
+            for handler in self._handlers.get(name, []):
+                try:
+                    handler(class_changes)
+                except Exception:
+                    log.exception(f'change feed handler failed for class {name}')
+
+        return len(rows)
+
+
+_change_feed = ChangeFeed()
+
+
+def get_change_feed():
+    return _change_feed
+
+# EOF
@@ -11,7 +11,7 @@ Please read the README.txt of this software.
 import logging
 
 from sqlalchemy import (and_, or_, schema, types, MetaData, Sequence, Column, ForeignKey,
-                        UniqueConstraint, Table, Identity, select)
+                        UniqueConstraint, Table, Identity, Index, select, delete)
 from sqlalchemy.orm import relationship, backref, dynamic_loader, deferred, column_property
 from sqlalchemy.orm.collections import column_mapped_collection, attribute_mapped_collection
 from sqlalchemy.orm.session import object_session
@@ -24,6 +24,8 @@ from sqlalchemy.sql.functions import current_timestamp, now
 from rhombus.lib.utils import get_userid, get_groupid, set_func_userid
 
 import json
+import gzip
+import os
 import transaction
 import pickle
 import threading
@@ -61,6 +63,7 @@ class ClassRegistry(object):
         self._classes = {}
         self._by_class = {}
         self._by_id = {}
+        self._by_name = {}
 
     def register(self, cls):
         if hasattr(cls, '__typeid__'):
@@ -86,6 +89,7 @@ class ClassRegistry(object):
                     cls = self._classes[cls_name]
                     self._by_class[cls] = cls_id
                     self._by_id[cls_id] = cls
+                    self._by_name[cls_name] = cls_id
                     cls.__typeid__ = cls_id
                     del self._classes[cls_name]
                 except KeyError:
@@ -114,6 +118,10 @@ class ClassRegistry(object):
     def get_class(self, id):
         return self._by_id[id]
 
+    def get_id_by_name(self, name):
+        """ return class id of a registered class name, case insensitive """
+        return self._by_name[name.lower()]
+
     def update_table(self, class_table={}, nextid=1):
 
         assert get_datalogger(), "ERROR: ClassRegistry.update_table() should not be called!"
@@ -122,6 +130,7 @@ class ClassRegistry(object):
             class_table[cls_name] = nextid
             self._by_class[cls] = nextid
             self._by_id[nextid] = cls
+            self._by_name[cls_name] = nextid
             cls.__typeid__ = nextid
             nextid += 1
         return class_table
@@ -266,36 +275,150 @@ class DataLog(Base):
 
     user = relationship('User', uselist=False)
 
+    # history of an object is scanned backward by id, and archiving selects by stamp
+    __table_args__ = (Index('ix_datalogs_class_id_object_id_id', 'class_id', 'object_id', 'id'),
+                      Index('ix_datalogs_stamp', 'stamp'),
+                      {})
+
     def action(self):
         return DataLogger._actions[self.action_id]
 
     def classname(self):
         return ClsReg().get_class(self.class_id).__name__
 
+    @classmethod
+    def history(cls, target, dbsession, object_id=None, limit=50, before_id=None):
+        """ return the data logs of an object, newest first
+
+            target is either a logged instance, a class or a class name (in which case
+            object_id is required). Use the id of the last returned data log as
+            before_id to get the next page.
+        """
+        if isinstance(target, str):
+            class_id = _clsreg.get_id_by_name(target)
+        elif isinstance(target, type):
+            class_id = _clsreg.get_id(target)
+        else:
+            class_id = _clsreg.get_id(target.__class__)
+            object_id = target.id
+        if object_id is None:
+            raise ValueError('DataLog.history() requires object_id')
+
+        q = select(cls).where(cls.class_id == class_id, cls.object_id == object_id)
+        if before_id is not None:
+            q = q.where(cls.id < before_id)
+        return dbsession.scalars(q.order_by(cls.id.desc()).limit(limit)).all()
+
+    @classmethod
+    def create_indexes(cls, engine):
+        """ create indexes that do not exist yet in databases created by older versions """
+        for index in cls.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    @classmethod
+    def archive(cls, dbsession, before, outdir, batch=100000, commit=True):
+        """ move data logs older than before (a datetime) to gzip-compressed JSON-lines
+            files in outdir, batch rows per file, and return the number of archived rows
+
+            each line is [id, stamp, class_id, object_id, action_id, user_id], and each file
+            is written and synced before its rows are deleted in a separate transaction.
+            Nothing is written nor deleted if commit is False.
+        """
+        from zope.sqlalchemy import mark_changed
+
+        table = cls.__table__
+        count = 0
+        last_id = 0
+        if commit:
+            os.makedirs(outdir, exist_ok=True)
+
+        while True:
+            with transaction.manager:
+                rows = dbsession.execute(
+                    select(table.c.id, table.c.stamp, table.c.class_id, table.c.object_id,
+                           table.c.action_id, table.c.user_id)
+                    .where(table.c.stamp < before, table.c.id > last_id)
+                    .order_by(table.c.id).limit(batch)
+                ).all()
+            if not rows:
+                break
+            first_id, last_id = rows[0].id, rows[-1].id
+            count += len(rows)
+            if not commit:
+                continue
+
+            path = os.path.join(outdir, f'datalogs-{first_id:012d}-{last_id:012d}.jsonl.gz')
+            with open(path, 'wb') as fh:
+                with gzip.GzipFile(fileobj=fh, mode='wb') as gz:
+                    gz.write(''.join(
+                        json.dumps([r.id, r.stamp.isoformat(), r.class_id, r.object_id,
+                                    r.action_id, r.user_id], separators=(',', ':')) + '\n'
+                        for r in rows).encode('UTF-8'))
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            with transaction.manager:
+                dbsession.execute(delete(table).where(table.c.id >= first_id,
+                                                      table.c.id <= last_id,
+                                                      table.c.stamp < before))
+                mark_changed(dbsession)
+
+        return count
+
 
 class DataLogger(object):
-    """ DataLogger needs to use connection or sql-level insert,
-        conn = dbsession.connection()
-        or
-        dbsession.execute()
+    """ DataLogger buffers the data log records of each session during flush, and writes
+        them with a single executemany at the end of the flush (see meta.set_datalogger),
+        preserving the order of the mapper events and the user at the time of the event
     """
 
     _actions = {1: 'INSERT', 2: 'UPDATE', 3: 'DELETE'}
 
+    # key of the record buffer in session.info
+    buffer_key = 'rhombus.datalogs'
+
     def action_insert(self, instance):
-        typeid, objid = instance.__class__.__typeid__, instance.id
-        dbsession.execute(DataLog.__table__.insert().values(
-                          class_id=typeid, object_id=objid, action_id=1, user_id=get_userid()))
+        self.append(instance, 1)
 
     def action_update(self, instance):
-        typeid, objid = instance.__class__.__typeid__, instance.id
-        dbsession.execute(DataLog.__table__.insert().values(
-                          class_id=typeid, object_id=objid, action_id=2, user_id=get_userid()))
+        self.append(instance, 2)
 
     def action_delete(self, instance):
-        typeid, objid = instance.__class__.__typeid__, instance.id
-        dbsession.execute(DataLog.__table__.insert().values(
-                          class_id=typeid, object_id=objid, action_id=3, user_id=get_userid()))
+        self.append(instance, 3)
+
+    def append(self, instance, action_id):
+        session = object_session(instance) or dbsession()
+        session.info.setdefault(self.buffer_key, []).append(
+            dict(class_id=instance.__class__.__typeid__, object_id=instance.id,
+                 action_id=action_id, user_id=get_userid())
+        )
+
+    def append_ids(self, session, class_, object_ids, action_id):
+        """ buffer records of objects modified by core statements, which bypass the mapper
+            events, to be written by the next flush() of session
+        """
+        if getattr(class_, '__typeid__', -1) == -1:
+            return
+        user_id = get_userid()
+        session.info.setdefault(self.buffer_key, []).extend(
+            dict(class_id=class_.__typeid__, object_id=object_id, action_id=action_id,
+                 user_id=user_id)
+            for object_id in object_ids
+        )
+
+    def flush(self, session):
+        """ write all buffered records of session """
+        records = session.info.pop(self.buffer_key, None)
+        if records:
+            session.connection().execute(DataLog.__table__.insert(), records)
+
+    def commit(self, session):
+        """ called after session commits, records have been written by flush() """
+        pass
+
+    def discard(self, session):
+        """ drop all buffered records of session """
+        session.info.pop(self.buffer_key, None)
 
 
 class BaseMixIn(StampMixIn, AutoUpdateMixIn):
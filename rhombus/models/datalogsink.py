@@ -0,0 +1,365 @@
+
+# datalogsink.py - out-of-band data log sinks
+#
+# instead of inserting into datalogs table within the logged transaction, the data log
+# records of each committed transaction are put into a bounded queue and appended by a
+# background writer thread to a local JSON-lines segment file or to a separate SQLite
+# database, so that a mutation only costs a list append and a queue put per commit.
+#
+# enable by adding the following in the config file:
+#
+#   rhombus.data_logger = true
+#   rhombus.datalog.sink = jsonl                # db (default), jsonl or sqlite
+#   rhombus.datalog.path = %(here)s/db/datalogs # directory for jsonl, file for sqlite
+#   rhombus.datalog.fsync = interval            # always, interval or never
+#   rhombus.datalog.fsync_interval = 1
+#   rhombus.datalog.queue_size = 10000
+#   rhombus.datalog.overflow = block            # block or drop when queue is full
+#   rhombus.datalog.segment_size = 67108864
+#
+# records are imported into datalogs table with:
+#
+#   rbmgr --replaydatalog PATH --commit
+#
+# each JSON-lines record is [stamp, class_id, object_id, action_id, user_id], with stamp
+# being the local time of the commit. A segment file is written as *.jsonl.part and
+# renamed to *.jsonl when it reaches segment_size or when the process exits, and only
+# the renamed segments are imported. Segments left as *.jsonl.part by a crashed process
+# can be renamed manually before importing.
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from rhombus import configkeys as ck
+from .core import DataLogger, DataLog
+
+log = logging.getLogger(__name__)
+
+fsync_policies = ['always', 'interval', 'never']
+overflow_policies = ['block', 'drop']
+
+
+class DataLogSink(object):
+    """ DataLogSink
+
+        Base class of out-of-band data log sinks. Batches of records are put into a
+        bounded queue and written by a background thread, which is started lazily in
+        each process, hence the sink can be created before forking worker processes.
+        Subclasses implement open(), write(), sync() and finish(), which are only called
+        from the writer thread.
+    """
+
+    def __init__(self, path, fsync='interval', fsync_interval=1.0, queue_size=10000,
+                 overflow='block'):
+        if fsync not in fsync_policies:
+            raise ValueError(f'invalid data log fsync policy: {fsync}')
+        if overflow not in overflow_policies:
+            raise ValueError(f'invalid data log overflow policy: {overflow}')
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        atexit.register(self.close)
+
+    def put(self, records):
+        """ queue a list of records, blocking or dropping when the queue is full """
+        self._ensure_started()
+        try:
+            self._queue.put(records, block=(self.overflow == 'block'))
+        except queue.Full:
+            if not self.dropped:
+                log.warning('data log queue is full, dropping records')
+            self.dropped += len(records)
+
+    def close(self, timeout=None):
+        """ write all queued records and stop the writer thread of this process """
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+            self._pid = None
+
+    def stats(self):
+        """ return a dictionary of sink counters """
+        return dict(sink=self.__class__.__name__, path=self.path, written=self.written,
+                    dropped=self.dropped, errors=self.errors,
+                    queued=self._queue.qsize() if self._queue is not None else 0)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # either first use, or a forked child which does not have the writer thread
+            self._queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='rhombus-datalog',
+                                            daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+
+        q = self._queue
+        self.open()
+        last_sync = time.monotonic()
+        dirty = False
+        stop = False
+
+        while not stop:
+            try:
+                items = [q.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                items = []
+            # drain whatever has been queued to write it in a single batch
+            while True:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = []
+            for item in items:
+                if item is None:
+                    stop = True
+                else:
+                    records.extend(item)
+
+            if records:
+                try:
+                    self.write(records)
+                    self.written += len(records)
+                    dirty = True
+                except Exception:
+                    self.errors += len(records)
+                    log.exception(f'failed to write {len(records)} data log records')
+
+            if dirty and self.fsync != 'never' and (
+                    stop or self.fsync == 'always'
+                    or time.monotonic() - last_sync >= self.fsync_interval):
+                self.sync()
+                last_sync = time.monotonic()
+                dirty = False
+
+        self.finish()
+
+    def open(self):
+        raise NotImplementedError()
+
+    def write(self, records):
+        raise NotImplementedError()
+
+    def sync(self):
+        raise NotImplementedError()
+
+    def finish(self):
+        raise NotImplementedError()
+
+
+class JSONLinesSink(DataLogSink):
+    """ append records as JSON lines to segment files in a directory """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, **kwargs):
+        super().__init__(path, **kwargs)
+        self.segment_size = segment_size
+        self._fh = None
+        self._segno = 0
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._segno += 1
+        stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self._filename = os.path.join(
+            self.path, f'datalogs-{stamp}-{os.getpid()}-{self._segno:04d}.jsonl.part')
+        self._fh = open(self._filename, 'a', encoding='UTF-8')
+        self._size = 0
+
+    def write(self, records):
+        lines = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+        self._fh.write(lines)
+        # hand over to the OS, fsync is done by sync() according to the policy
+        self._fh.flush()
+        self._size += len(lines)
+        if self._size >= self.segment_size:
+            self.finish()
+            self.open()
+
+    def sync(self):
+        os.fsync(self._fh.fileno())
+
+    def finish(self):
+        if self.fsync != 'never':
+            self.sync()
+        self._fh.close()
+        if self._size > 0:
+            os.rename(self._filename, self._filename[:-len('.part')])
+        else:
+            os.remove(self._filename)
+        self._fh = None
+
+
+class SQLiteSink(DataLogSink):
+    """ insert records into datalogs table of a separate SQLite database, the fsync
+        policy is mapped to synchronous pragma in WAL mode
+    """
+
+    synchronous = {'always': 'FULL', 'interval': 'NORMAL', 'never': 'OFF'}
+
+    def open(self):
+        self._conn = connect_sqlite_sink(self.path)
+        self._conn.execute(f'PRAGMA synchronous = {self.synchronous[self.fsync]}')
+
+    def write(self, records):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO datalogs (stamp, class_id, object_id, action_id, user_id) '
+                'VALUES (?, ?, ?, ?, ?)', records)
+
+    def sync(self):
+        pass
+
+    def finish(self):
+        self._conn.close()
+
+
+def connect_sqlite_sink(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA busy_timeout = 5000')
+    conn.execute('CREATE TABLE IF NOT EXISTS datalogs ('
+                 'id INTEGER PRIMARY KEY AUTOINCREMENT, stamp TEXT NOT NULL, '
+                 'class_id INTEGER NOT NULL, object_id INTEGER NOT NULL, '
+                 'action_id INTEGER NOT NULL, user_id INTEGER)')
+    return conn
+
+
+class SinkDataLogger(DataLogger):
+    """ SinkDataLogger keeps the records written by each flush until the session commits,
+        and then hands them over to a DataLogSink, hence records of rolled back
+        transactions are never written
+    """
+
+    pending_key = 'rhombus.datalogs.pending'
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def flush(self, session):
+        records = session.info.pop(self.buffer_key, None)
+        if records:
+            session.info.setdefault(self.pending_key, []).extend(records)
+
+    def commit(self, session):
+        records = session.info.pop(self.pending_key, None)
+        if records:
+            stamp = datetime.datetime.now().isoformat()
+            self.sink.put([(stamp, r['class_id'], r['object_id'], r['action_id'],
+                            r['user_id']) for r in records])
+
+    def discard(self, session):
+        super().discard(session)
+        session.info.pop(self.pending_key, None)
+
+
+def create_datalogger(settings):
+    """ return DataLogger according to rhombus.datalog.* settings """
+
+    sink = settings.get(ck.rb_datalog_sink, 'db')
+    if sink == 'db':
+        return DataLogger()
+
+    path = settings.get(ck.rb_datalog_path)
+    if not path:
+        raise ValueError(f'{ck.rb_datalog_path} is required for data log sink: {sink}')
+    kwargs = dict(
+        fsync=settings.get(ck.rb_datalog_fsync, 'interval'),
+        fsync_interval=float(settings.get(ck.rb_datalog_fsync_interval, 1)),
+        queue_size=int(settings.get(ck.rb_datalog_queue_size, 10000)),
+        overflow=settings.get(ck.rb_datalog_overflow, 'block'),
+    )
+
+    if sink == 'jsonl':
+        return SinkDataLogger(JSONLinesSink(
+            path, segment_size=int(settings.get(ck.rb_datalog_segment_size, 64 * 1024 * 1024)),
+            **kwargs))
+    if sink == 'sqlite':
+        return SinkDataLogger(SQLiteSink(path, **kwargs))
+    raise ValueError(f'invalid data log sink: {sink}')
+
+
+# replay
+
+def _insert_records(dbsession, records):
+    dbsession.execute(DataLog.__table__.insert(), [
+        dict(stamp=datetime.datetime.fromisoformat(stamp), class_id=class_id,
+             object_id=object_id, action_id=action_id, user_id=user_id)
+        for stamp, class_id, object_id, action_id, user_id in records
+    ])
+    mark_changed(dbsession)
+
+
+def replay_datalog(path, dbsession, commit=True, batch=5000):
+    """ import records from a JSON-lines segment directory or a SQLite sink file into
+        datalogs table, in their original order, and return the number of records.
+        Each segment (or each batch for SQLite) is imported in its own transaction,
+        after which the segment is renamed to *.imported (or the rows are deleted from
+        the SQLite file). Nothing is written nor removed if commit is False.
+    """
+
+    count = 0
+
+    if os.path.isdir(path):
+        segments = sorted(f for f in os.listdir(path) if f.endswith('.jsonl'))
+        for segment in segments:
+            filename = os.path.join(path, segment)
+            with open(filename, encoding='UTF-8') as fh:
+                records = [json.loads(line) for line in fh if line.strip()]
+            if commit:
+                with transaction.manager:
+                    for i in range(0, len(records), batch):
+                        _insert_records(dbsession, records[i:i + batch])
+                os.rename(filename, filename + '.imported')
+            count += len(records)
+        return count
+
+    conn = connect_sqlite_sink(path)
+    try:
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT id, stamp, class_id, object_id, action_id, user_id '
+                                'FROM datalogs WHERE id > ? ORDER BY id LIMIT ?',
+                                (last_id, batch)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            if commit:
+                with transaction.manager:
+                    _insert_records(dbsession, [row[1:] for row in rows])
+                with conn:
+                    conn.execute('DELETE FROM datalogs WHERE id <= ?', (last_id,))
+            count += len(rows)
+    finally:
+        conn.close()
+    return count
+
+# EOF
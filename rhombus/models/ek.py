@@ -11,11 +11,21 @@ Please read the README.txt of this software.
 from .core import (registered, Column, types, Base, BaseMixIn, object_session, column_property,
                    ForeignKey, deferred, Identity, relationship, UniqueConstraint, backref,
                    column_mapped_collection, association_proxy, Table, metadata, and_,
-                   NoResultFound)
+                   NoResultFound, SysReg, select)
+from .meta import RhoSession, get_datalogger
 
 from rhombus.lib.utils import get_dbhandler, cerr
+from rhombus.lib.cache import LRUCache
 
+from sqlalchemy import event, func, Index, bindparam, tuple_, inspect, text
+from sqlalchemy.orm import aliased
+from zope.sqlalchemy import mark_changed
+
+from itertools import chain
 import json
+import threading
+import time
+import uuid
 import yaml
 
 
@@ -40,7 +50,10 @@ class EK(BaseMixIn, Base):
     group_id = Column(types.Integer, ForeignKey('groups.id'))
     group = relationship('Group', uselist=False)
 
-    __table_args__ = (UniqueConstraint('key', 'member_of_id'), {})
+    __table_args__ = (UniqueConstraint('key', 'member_of_id'),
+                      # for case-insensitive exact match lookup in EK.search()
+                      Index('ix_eks_lower_key_member_of_id', func.lower(key), member_of_id),
+                      {})
 
     def __init__(self, key='', desc='', data='', member_of_id=None, parent=None):
         self.key = key
@@ -61,6 +74,9 @@ class EK(BaseMixIn, Base):
             self.member_of_id = obj.member_of_id
 
     def as_dict(self):
+        if self.id is not None and (dbsession := object_session(self)) is not None:
+            # load the whole subtree with a single recursive query
+            return EK.as_dicts([self.id], dbsession)[0]
         d = super().as_dict()
         d['group'] = self.group.name if self.group else None
         d['members'] = [m.as_dict() for m in self.members]
@@ -118,13 +134,14 @@ class EK(BaseMixIn, Base):
 
     @staticmethod
     def _key(id, dbsession):
-        key_pair = dbsession.get_key(id)
+        key_pair = _ek_cache.get_key(id, dbsession)
         if key_pair:
             return key_pair[0]
 
         ek = EK.get(id, dbsession)
         if ek:
-            dbsession.set_key((ek.key, ek.member_of.key if ek.member_of else None), ek.id)
+            _ek_cache.set_key((ek.key, ek.member_of.key if ek.member_of else None), ek.id,
+                              dbsession)
             return ek.key
 
         return None
@@ -135,7 +152,7 @@ class EK(BaseMixIn, Base):
         assert grp or key[0] == '@'
         if dbsession is None:
             dbsession = get_dbhandler().session()
-        id = dbsession.get_id((key, grp))
+        id = _ek_cache.get_id((key, grp), dbsession)
         if id:
             return id
 
@@ -150,7 +167,10 @@ class EK(BaseMixIn, Base):
             dbsession.add(ek)
             dbsession.flush([ek])
 
-        dbsession.set_key((ek.key, grp), ek.id)
+        # cache the actual key for reverse lookup, as key might differ in letter case
+        _ek_cache.set_key((ek.key, grp), ek.id, dbsession)
+        if ek.key != key:
+            _ek_cache.set_id((key, grp), ek.id, dbsession)
         return ek.id
 
     @staticmethod
@@ -159,21 +179,101 @@ class EK(BaseMixIn, Base):
 
     @staticmethod
     def getids(keys, dbsession, grp=None, auto=False):
-        return [EK.getid(k, dbsession, grp, auto) for k in keys]
+        """ return a list of ids of keys (as strings) within group grp, resolving all
+            uncached keys with a single query
+        """
+        assert grp or all(k[0] == '@' for k in keys)
+        ids = {}
+        missing = set()
+        for k in keys:
+            if (id := _ek_cache.get_id((k, grp), dbsession)):
+                ids[k] = id
+            else:
+                missing.add(k)
+
+        if missing:
+            q = select(EK.id, EK.key).where(func.lower(EK.key).in_({k.lower() for k in missing}))
+            if grp:
+                q = q.where(EK.member_of_id == EK._id(grp, dbsession))
+            db_ids = {}
+            with dbsession.no_autoflush:
+                for id, key in dbsession.execute(q):
+                    db_ids.setdefault(key.lower(), (id, key))
+            for k in missing:
+                if k.lower() in db_ids:
+                    id, key = db_ids[k.lower()]
+                    _ek_cache.set_key((key, grp), id, dbsession)
+                    if key != k:
+                        _ek_cache.set_id((k, grp), id, dbsession)
+                    ids[k] = id
+                else:
+                    # let EK._id() handle either the auto creation or the KeyError
+                    ids[k] = EK._id(k, dbsession, grp, auto)
+
+        return [ids[k] for k in keys]
 
     @staticmethod
     def getkey(id, dbsession):
         return EK._key(id, dbsession)
 
     @staticmethod
-    def getkeys(ids):
-        return [EK.getkey(id) for id in ids]
+    def getkeys(ids, dbsession):
+        """ return a list of keys of ids, resolving all uncached ids with a single query;
+            unknown ids (or None) yield None
+        """
+        keys = {}
+        missing = set()
+        for id in ids:
+            if id is None or id in keys:
+                continue
+            if (key_pair := _ek_cache.get_key(id, dbsession)):
+                keys[id] = key_pair[0]
+            else:
+                missing.add(id)
+
+        if missing:
+            parent = aliased(EK)
+            q = select(EK.id, EK.key, parent.key).outerjoin(
+                parent, parent.id == EK.member_of_id).where(EK.id.in_(missing))
+            with dbsession.no_autoflush:
+                for id, key, parent_key in dbsession.execute(q):
+                    _ek_cache.set_key((key, parent_key), id, dbsession)
+                    keys[id] = key
+
+        return [keys.get(id, None) for id in ids]
+
+    @staticmethod
+    def prefetch(objs, dbsession=None):
+        """ resolve all EK proxy fields of objs (instances of BaseMixIn subclasses) in one
+            pass, so that subsequent access to the proxies does not need to query the database
+        """
+        ek_ids = set()
+        attrnames = {}
+        for obj in objs:
+            cls = obj.__class__
+            if cls not in attrnames:
+                metainfo = getattr(cls, '__ek_metainfo__', None) or {}
+                attrnames[cls] = [item[0] for item in metainfo.values()]
+            for attrname in attrnames[cls]:
+                if (id := getattr(obj, attrname)) is not None:
+                    ek_ids.add(id)
+            if dbsession is None:
+                dbsession = object_session(obj)
+
+        if ek_ids:
+            EK.getkeys(list(ek_ids), dbsession or get_dbhandler().session())
+        return objs
 
     @staticmethod
     def search(key, group=None, dbsession=None):
         assert dbsession, "Please provide dbsession!"
         assert group is None or type(group) == str or isinstance(group, EK), "group argument must be string, None or instance of EK"
-        q = EK.query(dbsession).autoflush(False).filter(EK.key.ilike(key))
+        if '%' in key:
+            # pattern match, which cannot use any index
+            q = EK.query(dbsession).autoflush(False).filter(EK.key.ilike(key))
+        else:
+            # case-insensitive exact match using ix_eks_lower_key_member_of_id
+            q = EK.query(dbsession).autoflush(False).filter(func.lower(EK.key) == key.lower())
         if group:
             if type(group) == str:
                 q = q.filter(EK.member_of_id == EK._id(group, dbsession=dbsession))
@@ -244,6 +344,118 @@ class EK(BaseMixIn, Base):
 
     bulk_insert = bulk_update
 
+    @classmethod
+    def create_indexes(cls, engine):
+        """ create indexes that do not exist yet in databases created by older versions,
+            if the table has been created
+        """
+        with engine.begin() as conn:
+            if not inspect(conn).has_table(cls.__tablename__):
+                return
+            for index in cls.__table__.indexes:
+                if not _has_index(conn, cls.__tablename__, index.name):
+                    cerr(f'[Creating index {index.name}]')
+                    index.create(bind=conn)
+
+    @staticmethod
+    def bulk_upsert(alist, dbsession, parent=None, syskey=False, update=False):
+        """ insert EK trees in alist, and also update the existing EKs if update is True,
+            using a few executemany statements per tree level instead of a round-trip
+            per key. alist is either in the nested tuple format of EK.bulk_update() or
+            a list of dictionaries in the format of EK.as_dict().
+            Return a tuple of (inserted, updated) counts.
+        """
+        from .user import Group
+
+        dbsession.flush()
+        t = EK.__table__
+        insert_stmt = _insert_ignore_stmt(t, dbsession.get_bind().dialect.name)
+        update_stmt = t.update().where(t.c.id == bindparam('_id')).values(
+            desc=bindparam('desc'), data=bindparam('data'), syskey=bindparam('syskey'))
+        group_ids = {}
+        new_parent_ids = set()
+
+        level = []
+        for item in alist:
+            node = _ek_node(item, syskey)
+            if parent is not None:
+                parent_id = parent.id
+            elif node['member_of']:
+                parent_id = EK.search(node['member_of'], dbsession=dbsession).id
+            else:
+                parent_id = None
+            level.append((parent_id, node))
+
+        inserted = updated = 0
+        inserted_ids, updated_ids = [], []
+        while level:
+
+            # merge duplicated keys under the same parent, the later one wins
+            nodes = {}
+            for parent_id, node in level:
+                nodes[(parent_id, node['key'].lower())] = node
+
+            # resolve group names
+            group_names = {n['group'] for n in nodes.values()
+                           if n['group'] and n['group'] not in group_ids}
+            if group_names:
+                group_ids.update(dbsession.execute(
+                    select(Group.name, Group.id).where(Group.name.in_(group_names))).all())
+
+            existing = _fetch_ek_rows(nodes.keys(), dbsession, new_parent_ids)
+
+            inserts, updates = [], []
+            for (parent_id, lower_key), node in nodes.items():
+                group_id = group_ids.get(node['group'], None)
+                row = existing.get((parent_id, lower_key))
+                if row is None:
+                    desc = '-' if node['desc'] is None else node['desc']
+                    inserts.append(dict(key=node['key'], desc=desc,
+                                        data=node['data'], syskey=node['syskey'],
+                                        member_of_id=parent_id, group_id=group_id))
+                elif update:
+                    desc = row.desc if node['desc'] is None else node['desc']
+                    data = row.data if node['data'] is None else node['data']
+                    if (desc, data, node['syskey']) != (row.desc, row.data, row.syskey):
+                        updates.append(dict(_id=row.id, desc=desc, data=data,
+                                            syskey=node['syskey']))
+
+            if inserts:
+                res = dbsession.execute(insert_stmt, inserts)
+                inserted_rows = _fetch_ek_rows(
+                    [(d['member_of_id'], d['key'].lower()) for d in inserts], dbsession)
+                existing.update(inserted_rows)
+                new_parent_ids = {row.id for row in inserted_rows.values()}
+                # rows skipped by ON CONFLICT DO NOTHING (ie. inserted concurrently) are
+                # not counted, unless the driver does not report the row count
+                inserted += res.rowcount if res.rowcount >= 0 else len(inserts)
+                inserted_ids.extend(sorted(new_parent_ids))
+            else:
+                new_parent_ids = set()
+            if updates:
+                res = dbsession.execute(update_stmt, updates)
+                updated += res.rowcount if res.rowcount >= 0 else len(updates)
+                updated_ids.extend(d['_id'] for d in updates)
+
+            level = [(existing[key].id, member)
+                     for key, node in nodes.items() for member in node['members']]
+
+        if inserted_ids or updated_ids:
+            # core statements bypass the mapper and flush events, so write the data logs
+            # and invalidate EK caches manually
+            data_logger = get_datalogger()
+            if data_logger is not None:
+                data_logger.append_ids(dbsession, EK, inserted_ids, 1)
+                data_logger.append_ids(dbsession, EK, updated_ids, 2)
+                data_logger.flush(dbsession)
+            bump_ek_version(dbsession)
+            mark_changed(dbsession)
+            for obj in list(dbsession.identity_map.values()):
+                if isinstance(obj, EK):
+                    dbsession.expire(obj)
+
+        return inserted, updated
+
     @staticmethod
     def proxy(attrname, grpname, match_case=False, auto=False, default=None):
         """
@@ -280,11 +492,67 @@ class EK(BaseMixIn, Base):
         return property(_ek_proxy_getter, _ek_proxy_setter, doc=f'EK.proxy {attrname} {grpname}')
 
     @staticmethod
-    def dump(_out, query=None, dbsession=None):
+    def as_dicts(root_ids, dbsession):
+        """ return a list of dictionaries (with the same structure as EK.as_dict()) of
+            the EK trees under root_ids, loaded with a single recursive query and
+            assembled in memory
+        """
+        from .user import Group, User
+
+        tree = select(EK.id).where(EK.id.in_(root_ids)).cte('ek_tree', recursive=True)
+        tree = tree.union_all(select(EK.id).join(tree, EK.member_of_id == tree.c.id))
+
+        parent = aliased(EK)
+        q = select(
+            EK.id, EK.key, EK.desc, EK.data, EK.syskey, EK.member_of_id, EK.create_time,
+            EK.stamp, parent.key, Group.name, User.login
+        ).join(tree, EK.id == tree.c.id).outerjoin(
+            parent, parent.id == EK.member_of_id).outerjoin(
+            Group, Group.id == EK.group_id).outerjoin(
+            User, User.id == EK.lastuser_id).order_by(EK.key)
+
+        nodes = {}
+        children = []
+        for (id, key, desc, data, syskey, member_of_id, create_time, stamp,
+                parent_key, group_name, lastuser_login) in dbsession.execute(q):
+            d = dict(key=key, desc=desc, syskey=syskey, create_time=create_time, stamp=stamp)
+            if data is not None:
+                d['data'] = data
+            if parent_key is not None:
+                d['member_of'] = parent_key
+            if lastuser_login is not None:
+                d['lastuser'] = lastuser_login
+            d['group'] = group_name
+            d['members'] = []
+            nodes[id] = d
+            children.append((member_of_id, d))
+
+        # rows are sorted by key, so members are appended in the same order as EK.members
+        for member_of_id, d in children:
+            if member_of_id in nodes:
+                nodes[member_of_id]['members'].append(d)
+
+        return [nodes[id] for id in root_ids if id in nodes]
+
+    @staticmethod
+    def dump(_out, query=None, dbsession=None, format='yaml'):
+        """ write EK trees of query (or all root EKs) to _out as YAML documents or a JSON list
+        """
         assert dbsession, "Please provide dbsession"
-        if not query:
-            query = EK.query(dbsession).filter(EK.member_of_id is None)
-        yaml.safe_dump_all((x.as_dict() for x in query), _out, default_flow_style=False)
+        if query is None:
+            query = EK.query(dbsession).filter(EK.member_of_id == None)  # noqa: E711
+        root_ids = [x if type(x) == int else x.id for x in query]
+        ek_dicts = EK.as_dicts(root_ids, dbsession)
+
+        if format == 'json':
+            _out.write('[\n')
+            for i, d in enumerate(ek_dicts):
+                if i > 0:
+                    _out.write(',\n')
+                json.dump(d, _out, default=_json_default)
+            _out.write('\n]\n')
+        else:
+            yaml.safe_dump_all(ek_dicts, _out, default_flow_style=False)
 
     @classmethod
     def bulk_dump_xxx(cls, dbh, query=None):
@@ -302,4 +570,224 @@ class EK(BaseMixIn, Base):
     def load(_in):
         import yaml
 
+
+def _ek_node(item, syskey=False):
+    """ normalize an item of EK.bulk_update() tuple format or EK.as_dict() format """
+    if type(item) == str:
+        return dict(key=item, desc=item, data=None, syskey=syskey, group=None,
+                    member_of=None, members=[])
+
+    if isinstance(item, dict):
+        key, desc, data = item['key'], item.get('desc', None), item.get('data', None)
+        syskey = item.get('syskey', syskey)
+        group, member_of = item.get('group', None), item.get('member_of', None)
+        members = item.get('members', [])
+    else:
+        (key, desc) = item[:2]
+        data = group = member_of = None
+        members = item[2] if len(item) == 3 else []
+        if type(desc) == list:
+            desc, data = desc[0], desc[1]
+
+    if type(data) is str:
+        data = data.encode('UTF-8')
+    return dict(key=key, desc=desc, data=data, syskey=bool(syskey), group=group,
+                member_of=member_of, members=[_ek_node(m, syskey) for m in members])
+
+
+def _fetch_ek_rows(parent_key_pairs, dbsession, new_parent_ids=None, chunk_size=500):
+    """ return {(member_of_id, lower(key)): row} of existing EKs;
+        parents in new_parent_ids are known to have no members yet and are skipped
+    """
+    t = EK.__table__
+    columns = [t.c.id, t.c.key, t.c.member_of_id, t.c.desc, t.c.data, t.c.syskey]
+    new_parent_ids = new_parent_ids or set()
+    wanted = {pair for pair in parent_key_pairs if pair[0] not in new_parent_ids}
+    root_keys = sorted({key for pid, key in wanted if pid is None})
+    parent_ids = sorted({pid for pid, key in wanted if pid is not None})
+
+    # root keys are looked up with ix_eks_lower_key_member_of_id, while members are
+    # fetched per parent with ix_eks_member_of_id, since (expression, column) IN (...)
+    # cannot use a functional index on some databases
+    queries = []
+    for i in range(0, len(root_keys), chunk_size):
+        queries.append(select(*columns).where(
+            func.lower(t.c.key).in_(root_keys[i:i + chunk_size]),
+            t.c.member_of_id == None))  # noqa: E711
+    for i in range(0, len(parent_ids), chunk_size):
+        queries.append(select(*columns).where(
+            t.c.member_of_id.in_(parent_ids[i:i + chunk_size])))
+
+    rows = {}
+    for q in queries:
+        for row in dbsession.execute(q):
+            if (pair := (row.member_of_id, row.key.lower())) in wanted:
+                rows[pair] = row
+    return rows
+
+
+def _has_index(conn, table_name, index_name):
+    """ check whether index exists, including expression-based indexes which are not
+        reflected (hence not checked by Index.create(checkfirst=True)) on some dialects
+    """
+    if conn.dialect.name == 'sqlite':
+        return conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+            dict(name=index_name)).first() is not None
+    if conn.dialect.name == 'postgresql':
+        return conn.execute(text(
+            'SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() '
+            'AND tablename = :table_name AND indexname = :name'),
+            dict(table_name=table_name, name=index_name)).first() is not None
+    return index_name in {ix['name'] for ix in inspect(conn).get_indexes(table_name)}
+
+
+def _insert_ignore_stmt(table, dialect_name):
+    """ return an INSERT statement skipping conflicting rows where the dialect supports it """
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+
+def _json_default(obj):
+    if isinstance(obj, bytes):
+        return obj.decode('UTF-8', errors='replace')
+    return str(obj)
+
+
+# process-wide EK cache
+
+EK_VERSION_KEY = '__ek_version__'
+
+
+class EKCache(object):
+    """ EKCache
+
+        A process-wide, thread-safe cache of EK (key, group) <-> id mapping that survives
+        transactions. Every insert, update or delete of EK bumps a version token stored in
+        SysReg, which is compared at most once every check_interval seconds, so that other
+        processes can detect a stale cache cheaply. Sessions with uncommitted EK changes
+        only use their own session-local cache.
+    """
+
+    def __init__(self, maxsize=4096, check_interval=5.0):
+        self.configure(maxsize, check_interval)
+
+    def configure(self, maxsize=4096, check_interval=5.0):
+        self._ids = LRUCache(maxsize)      # (key, grp) -> id
+        self._keys = LRUCache(maxsize)     # id -> (key, grp)
+        self._lock = threading.Lock()
+        self.check_interval = check_interval
+        self.version = None
+        self._checked_at = None
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._keys.clear()
+            self.version = None
+            self._checked_at = None
+
+    def validate(self, dbsession):
+        """ clear the cache if the EK version in the database has changed """
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        version = get_ek_version(dbsession)
+        with self._lock:
+            if version != self.version:
+                self._ids.clear()
+                self._keys.clear()
+                self.version = version
+            self._checked_at = now
+
+    def get_id(self, key, dbsession):
+        if dbsession.ek_dirty:
+            return dbsession.get_id(key)
+        self.validate(dbsession)
+        return self._ids.get(key)
+
+    def get_key(self, id, dbsession):
+        if dbsession.ek_dirty:
+            return dbsession.get_key(id)
+        self.validate(dbsession)
+        return self._keys.get(id)
+
+    def set_id(self, key, id, dbsession):
+        if dbsession.ek_dirty:
+            dbsession.set_id(key, id)
+        else:
+            self._ids.set(key, id)
+
+    def set_key(self, key, id, dbsession):
+        if dbsession.ek_dirty:
+            dbsession.set_key(key, id)
+        else:
+            self._ids.set(key, id)
+            self._keys.set(id, key)
+
+    def stats(self):
+        return dict(version=self.version, ids=self._ids.stats(), keys=self._keys.stats())
+
+    def warmup(self, dbsession):
+        """ fill the cache with up to maxsize EKs using a single query, eg. before forking
+            worker processes, and return the number of cached EKs
+        """
+        self.validate(dbsession)
+        parent = aliased(EK)
+        rows = dbsession.execute(
+            select(EK.id, EK.key, parent.key).outerjoin(parent, EK.member_of_id == parent.id)
+            .order_by(EK.id).limit(self._keys.maxsize)
+        ).all()
+        for id, key, grp in rows:
+            self.set_key((key, grp), id, dbsession)
+        return len(rows)
+
+
+_ek_cache = EKCache()
+
+
+def get_ek_cache():
+    return _ek_cache
+
+
+def get_ek_version(dbsession):
+    """ return the current EK version token, or None if EKs have never been modified """
+    t = SysReg.__table__
+    return dbsession.connection().execute(
+        select(t.c.bindata).where(t.c.key == EK_VERSION_KEY)).scalar()
+
+
+def bump_ek_version(dbsession):
+    """ store a new EK version token, invalidating EK caches in all processes once
+        the transaction is committed
+    """
+    t = SysReg.__table__
+    token = uuid.uuid4().hex.encode('ASCII')
+    conn = dbsession.connection()
+    res = conn.execute(t.update().where(t.c.key == EK_VERSION_KEY).values(bindata=token))
+    if res.rowcount == 0:
+        conn.execute(t.insert().values(key=EK_VERSION_KEY, bindata=token,
+                                       mimetype='application/octet-stream'))
+    dbsession.ek_dirty = True
+    return token
+
+
+@event.listens_for(RhoSession, 'after_flush')
+def bump_ek_version_after_flush(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, EK):
+            bump_ek_version(session)
+            break
+
+
+@event.listens_for(RhoSession, 'after_commit')
+def clear_ek_cache_after_commit(session):
+    if session.ek_dirty:
+        _ek_cache.clear()
+
 # end of file
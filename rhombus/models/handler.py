@@ -1,10 +1,15 @@
 
 import sys
+from itertools import chain
 
 from rhombus.lib.utils import cerr, cout
-from rhombus.models import (core, meta, ek, user, actionlog, filemgr)
-from sqlalchemy import engine_from_config, event, or_, and_, select
-from sqlalchemy.orm import exc
+from rhombus import configkeys as ck
+from rhombus.models import (core, meta, ek, user, actionlog, filemgr, pool, datalogsink)
+from rhombus.lib.cache import LRUCache
+from sqlalchemy import engine_from_config, event, or_, and_, select, bindparam, tuple_
+from sqlalchemy.engine import make_url
+from pyramid.settings import asbool
+from sqlalchemy.orm import exc, Query
 
 cinfo = print
 
@@ -14,9 +19,19 @@ cinfo = print
 #
 
 class QueryConstructor(object):
+    """ QueryConstructor
 
-    def __init__(self):
-        pass
+        Construct filter expressions from selectors, ie. lists (OR) of dictionaries (AND)
+        of field_tag: value.
+
+        Selectors are also normalized into shapes, ie. the structure of the selector
+        without the values, so that compound queries can be built once per shape with
+        bound parameters (expanding for IN) and reused with different values.
+    """
+
+    def __init__(self, maxsize=256):
+        # entries are [object, hits, misses], so that the counters go with the entry
+        self._cache = LRUCache(maxsize)
 
     def construct_query_from_list(self, a_list):
         exprs = []
@@ -42,13 +57,80 @@ class QueryConstructor(object):
                 exprs.append(f.in_(val))
             elif isinstance(val, tuple):
                 exprs.append(f.in_(val))
-            elif '%' in val:
+            elif isinstance(val, str) and '%' in val:
                 exprs.append(f.ilike(val))
             else:
                 exprs.append(f == val)
 
         return and_(*exprs), classes
 
+    def normalize_selector(self, a_list):
+        """ return (shape, params), where shape is a hashable structure of a_list and params
+            is a dictionary of the values for the bound parameters of the shape
+        """
+        shape = []
+        params = {}
+        for i, a_dict in enumerate(a_list):
+            spec_shape = []
+            for k in sorted(a_dict):
+                val = a_dict[k]
+                if val is None:
+                    # rendered as IS NULL, hence no bound parameter
+                    spec_shape.append((k, 'isnull'))
+                    continue
+                if isinstance(val, (list, tuple)):
+                    op, val = 'in', list(val)
+                elif isinstance(val, str) and '%' in val:
+                    op = 'ilike'
+                else:
+                    op = 'eq'
+                spec_shape.append((k, op))
+                params[f'p{i}_{k}'] = val
+            shape.append(tuple(spec_shape))
+        return tuple(shape), params
+
+    def construct_expr_from_shape(self, shape):
+        """ return (expr, classes) with bound parameters named as in normalize_selector(),
+            with expr being None for empty shape
+        """
+        exprs = []
+        classes = set()
+        for i, spec_shape in enumerate(shape):
+            spec_exprs = []
+            for k, op in spec_shape:
+                f = self.field_specs[k]
+                classes.add(f.class_)
+                param = f'p{i}_{k}'
+                if op == 'isnull':
+                    spec_exprs.append(f.is_(None))
+                elif op == 'in':
+                    spec_exprs.append(f.in_(bindparam(param, expanding=True)))
+                elif op == 'ilike':
+                    spec_exprs.append(f.ilike(bindparam(param)))
+                else:
+                    spec_exprs.append(f == bindparam(param))
+            exprs.append(and_(*spec_exprs))
+
+        return (or_(*exprs) if exprs else None), classes
+
+    def get_cached(self, key, builder):
+        """ return cached object of key, or the object created by builder() """
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = [builder(), 0, 1]
+            self._cache.set(key, entry)
+        else:
+            entry[1] += 1
+        return entry[0]
+
+    def cache_stats(self):
+        """ return a list of (object_name, shape, hits, misses) of the cached entries,
+            sorted by most hits
+        """
+        return sorted(((key[0].__name__, key[1], hits, misses)
+                       for key, (obj, hits, misses) in self._cache.items()),
+                      key=lambda x: -x[2])
+
     # field specs contains field_tag: column_class
     field_specs = {
         'userclass_id': user.UserClass.id,
@@ -62,6 +144,43 @@ class QueryConstructor(object):
     }
 
 
+class Page(list):
+    """ Page
+
+        A list of objects of a single page from keyset pagination, with cursor being
+        the (order_value, id) of the last object to be passed for fetching the next page,
+        or None if this is the last page.
+    """
+
+    def __init__(self, items, cursor=None):
+        super().__init__(items)
+        self.cursor = cursor
+
+    @property
+    def has_next(self):
+        return self.cursor is not None
+
+
+def supports_row_values(dialect):
+    """ check whether dialect supports row value comparison, ie. (a, b) > (x, y) """
+    if dialect.name == 'sqlite':
+        return getattr(dialect.dbapi, 'sqlite_version_info', (0, )) >= (3, 15)
+    return dialect.name in ('postgresql', 'mysql', 'mariadb')
+
+
+def keyset_criterion(order_col, id_col, cursor, dialect=None):
+    """ return criterion for rows located after cursor in (order_col, id_col) ordering,
+        as a row value comparison which can be used as a single range scan on an index
+        of (order_col, id_col) where the dialect supports it
+    """
+    order_value, id_value = cursor
+    if order_col is id_col:
+        return id_col > id_value
+    if dialect is not None and supports_row_values(dialect):
+        return tuple_(order_col, id_col) > tuple_(order_value, id_value)
+    return or_(order_col > order_value, and_(order_col == order_value, id_col > id_value))
+
+
 class DBHandler(object):
 
     # put the objectclass that we need to directly access here
@@ -87,11 +206,26 @@ class DBHandler(object):
 
         cinfo("Connecting to database..")
 
-        self.engine = engine_from_config(settings, tag)
-
-        # check if SQLite, then set pragma
-        if self.engine.name.startswith('sqlite'):
-            event.listen(self.engine, 'connect', meta.set_sqlite_pragma)
+        # settings with prefix tag + 'replica.<name>.' are for read replica engines
+        replica_tag = tag + 'replica.'
+        self.engine = self.create_engine(
+            {k: v for k, v in settings.items() if not k.startswith(replica_tag)}, tag)
+
+        self.replica_names = sorted(set(k[len(replica_tag):].split('.', 1)[0]
+                                        for k in settings if k.startswith(replica_tag)))
+        self.replica_engines = [self.create_engine(settings, f'{replica_tag}{name}.')
+                                for name in self.replica_names]
+        if self.replica_engines:
+            cinfo(f'Using read replica(s): {", ".join(self.replica_names)}')
+        meta.set_replica_engines(
+            self.replica_engines,
+            sticky_window=float(settings.get(ck.rb_replica_sticky_window, 2)))
+
+        if not initial:
+            # databases created before the group closure table and the index for
+            # case-insensitive EK lookup were introduced
+            user.GroupClosure.ensure(self.engine)
+            ek.EK.create_indexes(self.engine)
 
         use_logger = False
         if 'rhombus.data_logger' in settings:
@@ -99,16 +233,63 @@ class DBHandler(object):
 
         if not initial and use_logger == 'true':
             cinfo('data logger is being used!')
-            data_logger = core.DataLogger()
+            data_logger = datalogsink.create_datalogger(settings)
             meta.set_datalogger(data_logger)
 
             core.get_clsreg().sync()
 
+        ek.get_ek_cache().configure(
+            maxsize=int(settings.get(ck.rb_ekcache_maxsize, 4096)),
+            check_interval=float(settings.get(ck.rb_ekcache_check_interval, 5)))
+
         self.settings = settings
         self.session = meta.get_dbsession()
         self.session.configure(bind=self.engine)
         self._query_constructor = None
 
+    def create_engine(self, settings, tag):
+
+        # pool settings, non-SQLite databases use QueuePool which records wait times
+        kwargs = {}
+        if ck.rb_pool_recycle in self.settings:
+            kwargs['pool_recycle'] = int(self.settings[ck.rb_pool_recycle])
+        if ck.rb_pool_pre_ping in self.settings:
+            kwargs['pool_pre_ping'] = asbool(self.settings[ck.rb_pool_pre_ping])
+        if not make_url(settings[tag + 'url']).get_backend_name().startswith('sqlite'):
+            kwargs['poolclass'] = pool.TimedQueuePool
+            if ck.rb_pool_size in self.settings:
+                kwargs['pool_size'] = int(self.settings[ck.rb_pool_size])
+            if ck.rb_pool_max_overflow in self.settings:
+                kwargs['max_overflow'] = int(self.settings[ck.rb_pool_max_overflow])
+            if ck.rb_pool_timeout in self.settings:
+                kwargs['pool_timeout'] = float(self.settings[ck.rb_pool_timeout])
+
+        engine = engine_from_config(settings, tag, **kwargs)
+        pool.install_pool_stats(engine)
+
+        # check if SQLite, then set pragma
+        if engine.name.startswith('sqlite'):
+            pragmas = [(name, self.settings[ck.rb_sqlite_ + name]) for name in meta.sqlite_pragmas
+                       if ck.rb_sqlite_ + name in self.settings]
+            event.listen(engine, 'connect', meta.sqlite_pragma_listener(pragmas))
+
+        return engine
+
+    def dispose(self, close=True):
+        """ dispose connection pools of all engines, use close=False in a forked child
+            process to drop the inherited connections without closing them
+        """
+        for engine in [self.engine] + self.replica_engines:
+            engine.dispose(close=close)
+            engine.pool_stats.reset()
+
+    def pool_stats(self):
+        """ return dictionary of pool status & counters of primary and replica engines """
+        stats = {'primary': pool.pool_status(self.engine)}
+        for name, engine in zip(self.replica_names, self.replica_engines):
+            stats[f'replica.{name}'] = pool.pool_status(engine)
+        return stats
+
     def initdb(self, create_table=True, init_data=True, rootpasswd=None, ek_initlist=[]):
         """ prepare the database for the first time by initializing it with
             necessary, basic, default data set """
@@ -124,6 +305,10 @@ class DBHandler(object):
             setup(self, rootpasswd)
             cerr('[rhombus] Database has been initialized.')
 
+    def prefetch_ek(self, objs):
+        """ resolve EK proxy fields of all objs in one pass, return objs """
+        return self.EK.prefetch(objs, self.session())
+
     def get_userclass(self, userclass=None):
 
         if userclass is None:
@@ -141,13 +326,15 @@ class DBHandler(object):
 
     # UserClass
 
-    def get_userclasses(self, groups=None, specs=None, user=None, fetch=True, raise_if_empty=False):
+    def get_userclasses(self, groups=None, specs=None, user=None, fetch=True, raise_if_empty=False,
+                        cursor=None, page_size=100):
 
         q = self.construct_query(self.UserClass, specs)
-        if fetch:
-            q = q.order_by(self.UserClass.domain)
+        if fetch and fetch != 'page':
+            q = q.order_by(self.UserClass.domain, self.UserClass.id)
 
-        return self.fetch_query(q, fetch, raise_if_empty)
+        return self.fetch_query(q, fetch, raise_if_empty, order_col=self.UserClass.domain,
+                                cursor=cursor, page_size=page_size)
 
     def get_userclasses_by_ids(self, ids, groups=None, user=None, fetch=True, raise_if_empty=False):
         return self.get_userclasses(groups, [{'userclass_id': ids}], user=user, fetch=fetch,
@@ -155,13 +342,15 @@ class DBHandler(object):
 
     # User
 
-    def get_users(self, groups=None, specs=None, user=None, fetch=True, raise_if_empty=False):
+    def get_users(self, groups=None, specs=None, user=None, fetch=True, raise_if_empty=False,
+                  cursor=None, page_size=100):
 
         q = self.construct_query(self.User, specs)
-        if fetch:
-            q = q.order_by(self.User.login)
+        if fetch and fetch != 'page':
+            q = q.order_by(self.User.login, self.User.id)
 
-        return self.fetch_query(q, fetch, raise_if_empty)
+        return self.fetch_query(q, fetch, raise_if_empty, order_col=self.User.login,
+                                cursor=cursor, page_size=page_size)
 
     def get_users_by_ids(self, ids, groups=None, user=None, fetch=True, raise_if_empty=False):
         return self.get_users(groups, [{'user_id': ids}], user=user, fetch=fetch,
@@ -325,31 +514,73 @@ class DBHandler(object):
             filter ( or_( and_(Category.id.in_([1,2]), Collection.id.in_([5])) ) )
         """
 
-        q = self.session().query(object)
-
-        selector = selector or []
         constructor = self.get_query_constructor()
-        filter_expr, filter_classes = constructor.construct_query_from_list(selector)
-        filter_classes = filter_classes - {object}
-
-        for class_ in filter_classes:
-            q = q.join(class_)
+        shape, params = constructor.normalize_selector(selector or [])
+
+        def _build_query():
+            # a session-less query, to be attached to the current session for each call
+            q = Query(object)
+            filter_expr, filter_classes = constructor.construct_expr_from_shape(shape)
+            for class_ in filter_classes - {object}:
+                q = q.join(class_)
+            if filter_expr is not None:
+                q = q.filter(filter_expr)
+            return q
 
-        q = q.filter(filter_expr)
-        return q
+        q = constructor.get_cached((object, shape), _build_query)
+        return q.with_session(self.session()).params(params)
 
-    def fetch_query(self, query, fetch, raise_if_empty):
+    def fetch_query(self, query, fetch, raise_if_empty, order_col=None, cursor=None,
+                    page_size=100):
         """ prepare query results, either the query itself, the fetched objects
             or raised exception if necessary
+
+            fetch:  False - return the query
+                    True - return a list of all objects
+                    'stream' - return an iterator over objects, fetched page_size rows at a
+                               time using server-side cursors where supported
+                    'page' - return a Page of at most page_size objects located after
+                             cursor (order_value, id) in (order_col, id) ordering
         """
         if not fetch:
             return query
 
+        if fetch == 'stream':
+            return self._check_stream(query.yield_per(page_size), raise_if_empty)
+
+        if fetch == 'page':
+            id_col = query.column_descriptions[0]['entity'].id
+            order_col = order_col or id_col
+            if cursor is not None:
+                query = query.filter(
+                    keyset_criterion(order_col, id_col, cursor, self.engine.dialect))
+            res = query.order_by(order_col, id_col).limit(page_size + 1).all()
+            return self._make_page(res, order_col, page_size, raise_if_empty)
+
         res = query.all()
         if raise_if_empty and len(res) == 0:
             raise exc.NoResultFound()
         return res
 
+    def _check_stream(self, iterable, raise_if_empty):
+        """ return an iterator of iterable, raising NoResultFound early if necessary """
+        iterator = iter(iterable)
+        if not raise_if_empty:
+            return iterator
+        try:
+            first = next(iterator)
+        except StopIteration:
+            raise exc.NoResultFound()
+        return chain([first], iterator)
+
+    def _make_page(self, res, order_col, page_size, raise_if_empty):
+        if raise_if_empty and len(res) == 0:
+            raise exc.NoResultFound()
+        if len(res) > page_size:
+            last = res[page_size - 1]
+            return Page(res[:page_size], (getattr(last, order_col.key), last.id))
+        return Page(res)
+
     def rejoin(self, q, class_):
         if any(q._legacy_setup_joins):
             setup_joins = q._legacy_setup_joins
@@ -390,16 +621,31 @@ class DBHandler(object):
         for class_ in filter_classes:
             s = s.join(class_)
 
-        s = s.filter(filter_expr)
+        if selector:
+            s = s.filter(filter_expr)
         return s
 
-    def fetch_select(self, stmt, fetch, raise_if_empty):
+    def fetch_select(self, stmt, fetch, raise_if_empty, order_col=None, cursor=None,
+                     page_size=100):
         """ prepare query results, either the query itself, the fetched objects
-            or raised exception if necessary
+            or raised exception if necessary, with fetch modes similar to fetch_query()
         """
         if not fetch:
             return stmt
 
+        if fetch == 'stream':
+            return self._check_stream(
+                self.scalars(stmt.execution_options(yield_per=page_size)), raise_if_empty)
+
+        if fetch == 'page':
+            id_col = stmt.column_descriptions[0]['entity'].id
+            order_col = order_col or id_col
+            if cursor is not None:
+                stmt = stmt.where(
+                    keyset_criterion(order_col, id_col, cursor, self.engine.dialect))
+            res = self.scalars(stmt.order_by(order_col, id_col).limit(page_size + 1)).all()
+            return self._make_page(res, order_col, page_size, raise_if_empty)
+
         res = self.scalars(stmt).all()
         if raise_if_empty and len(res) == 0:
             raise exc.NoResultFound()
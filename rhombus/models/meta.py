@@ -19,8 +19,14 @@ from zope.sqlalchemy import register
 
 from rhombus.lib.utils import cerr
 
+import random
+import re
+import threading
+import time
 
-__all__ = ['get_base', 'get_dbsession', 'set_datalogger', 'set_before_update_flag']
+
+__all__ = ['get_base', 'get_dbsession', 'set_datalogger', 'set_before_update_flag',
+           'set_current_user', 'get_current_user', 'set_read_only', 'is_read_only']
 
 
 class RhoSession(Session):
@@ -28,23 +34,69 @@ class RhoSession(Session):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # EK idcache
+        # EK idcache, only used when this session has uncommitted EK changes,
+        # otherwise the process-wide EK cache (see ek.py) is used
         self._ek_keys = {}
         self._ek_ids = {}
+        self.ek_dirty = False
+
+        # memoized (group_ids, role_ids) of users, by user id
+        self._group_roles = {}
 
-        # current user information
-        self.user = None
+        # replica engine used by this transaction, and flag to stick to primary
+        # engine once this transaction has written to the database
+        self._replica = None
+        self.sticky_primary = False
+
+        # current user information, see user property below
         self.global_user = None	 # used for per-process user (eg. in scripts)
 
         # set flags
         self.before_update_event = True
 
-    def close(self):
-        self.user = None
-        super().close()
+    def _autoflush(self):
+        # autoflush is always off within read-only work, see set_read_only()
+        if is_read_only():
+            return
+        super()._autoflush()
+
+    def has_writes(self):
+        """ return True if this session has pending or flushed changes """
+        return bool(self.sticky_primary or self.new or self.dirty or self.deleted)
+
+    @property
+    def user(self):
+        """ current user, stored per thread so that it can be set without instantiating
+            a session
+        """
+        return get_current_user()
+
+    @user.setter
+    def user(self, user):
+        set_current_user(user)
 
     def set_user(self, user):
-        self.user = user
+        set_current_user(user)
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        """ route read-only statements to a replica engine when replica routing is
+            enabled for the current thread, otherwise use the primary engine
+        """
+        if _replica_engines and self._can_use_replica(clause):
+            if self._replica is None:
+                self._replica = random.choice(_replica_engines)
+            return self._replica
+        if getattr(clause, 'is_dml', False):
+            self.sticky_primary = True
+            _routing.written = True
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+    def _can_use_replica(self, clause):
+        return ((getattr(_routing, 'use_replicas', False) or is_read_only())
+                and not self.sticky_primary and not self._flushing
+                and getattr(clause, 'is_select', False)
+                and getattr(clause, '_for_update_arg', None) is None
+                and time.monotonic() - _last_write_time > _replica_sticky_window)
 
     # == EK helpers ==
 
@@ -58,6 +110,9 @@ class RhoSession(Session):
         self._ek_ids[key] = id
         self._ek_keys[id] = key
 
+    def set_id(self, key, id):
+        self._ek_ids[key] = id
+
     def clear_keys(self):
         self._ek_keys.clear()
         self._ek_ids.clear()
@@ -65,10 +120,34 @@ class RhoSession(Session):
     def set_before_update_event(self, value=True):
         self.before_update_event = value
 
+    # == group & role membership helpers ==
+
+    def get_group_roles(self, user_id):
+        return self._group_roles.get(user_id, None)
+
+    def set_group_roles(self, user_id, group_roles):
+        self._group_roles[user_id] = group_roles
+
+    def clear_group_roles(self):
+        self._group_roles.clear()
+
 
 @event.listens_for(RhoSession, 'after_transaction_end')
 def clear_session_cache(session, tx):
     session.clear_keys()
+    session.clear_group_roles()
+    if tx.parent is None:
+        session.ek_dirty = False
+        session._replica = None
+        session.sticky_primary = False
+
+
+@event.listens_for(RhoSession, 'after_flush')
+def set_sticky_primary(session, flush_context):
+    global _last_write_time
+    session.sticky_primary = True
+    _routing.written = True
+    _last_write_time = time.monotonic()
 
 
 @event.listens_for(mapper, 'before_update')
@@ -118,6 +197,33 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.close()
 
 
+# additional SQLite pragmas that can be set from settings, eg:
+#   rhombus.sqlite.journal_mode = WAL
+#   rhombus.sqlite.busy_timeout = 5000
+sqlite_pragmas = ['journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout',
+                  'temp_store']
+
+_re_pragma_value = re.compile(r'^-?\w+$')
+
+
+def sqlite_pragma_listener(pragmas):
+    """ return connect listener that sets foreign key support and pragmas, which is a list
+        of (name, value)
+    """
+    for name, value in pragmas:
+        if name not in sqlite_pragmas or not _re_pragma_value.match(str(value)):
+            raise ValueError(f'invalid SQLite pragma: {name} = {value}')
+
+    def _set_sqlite_pragma(dbapi_connection, connection_record):
+        set_sqlite_pragma(dbapi_connection, connection_record)
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return _set_sqlite_pragma
+
+
 # Rhombus data logger
 
 _datalogger = None
@@ -147,6 +253,23 @@ def _after_delete_listener(mapper, connection, target):
         _datalogger.action_delete(target)
 
 
+def _after_flush_postexec_listener(session, flush_context):
+    if _datalogger is not None:
+        _datalogger.flush(session)
+
+
+def _after_commit_listener(session):
+    if _datalogger is not None:
+        _datalogger.commit(session)
+
+
+def _after_transaction_end_listener(session, transaction):
+    # discard records left by a failed flush or a rolled back (or closed) transaction,
+    # records of a committed transaction have been taken by after_commit
+    if _datalogger is not None and transaction.parent is None:
+        _datalogger.discard(session)
+
+
 # public functions
 
 def set_datalogger(logger):
@@ -154,15 +277,89 @@ def set_datalogger(logger):
 
     global _datalogger
     _datalogger = logger
-    event.listen(mapper, 'after_insert', _after_insert_listener)
-    event.listen(mapper, 'after_update', _after_update_listener)
-    event.listen(mapper, 'after_delete', _after_delete_listener)
+    for target, identifier, func in [
+            (mapper, 'after_insert', _after_insert_listener),
+            (mapper, 'after_update', _after_update_listener),
+            (mapper, 'after_delete', _after_delete_listener),
+            (RhoSession, 'after_flush_postexec', _after_flush_postexec_listener),
+            (RhoSession, 'after_commit', _after_commit_listener),
+            (RhoSession, 'after_transaction_end', _after_transaction_end_listener)]:
+        # only register once, as the datalogger might be replaced
+        if not event.contains(target, identifier, func):
+            event.listen(target, identifier, func)
 
 
 def get_datalogger():
     return _datalogger
 
 
+# current user
+
+_usercontext = threading.local()
+
+
+def set_current_user(user):
+    """ set current user of this thread, used by sessions of this thread """
+    _usercontext.user = user
+
+
+def get_current_user():
+    return getattr(_usercontext, 'user', None)
+
+
+# read replica routing
+
+_replica_engines = []
+_replica_sticky_window = 0.0
+_last_write_time = 0.0
+_routing = threading.local()
+
+
+def set_replica_engines(engines, sticky_window=0.0):
+    """ set replica engines, with sticky_window as the number of seconds after the last
+        write in this process during which all statements are sent to primary engine
+    """
+    global _replica_engines, _replica_sticky_window
+    _replica_engines = list(engines)
+    _replica_sticky_window = sticky_window
+
+
+def get_replica_engines():
+    return _replica_engines
+
+
+def get_replica_sticky_window():
+    return _replica_sticky_window
+
+
+def set_written(flag=True):
+    """ set or clear the flag of the current thread indicating that a session has written
+        to the primary engine, eg. to keep the client on primary engine across processes
+    """
+    _routing.written = flag
+
+
+def has_written():
+    return getattr(_routing, 'written', False)
+
+
+def use_replicas(flag=True):
+    """ enable or disable replica routing for sessions in the current thread """
+    _routing.use_replicas = flag
+
+
+def set_read_only(flag=True):
+    """ mark the work in the current thread as read-only, which turns off autoflush and
+        allows replica routing; the database itself does not enforce read-only, as the
+        transaction has usually begun (eg. by role checks) before the flag is set
+    """
+    _routing.read_only = flag
+
+
+def is_read_only():
+    return getattr(_routing, 'read_only', False)
+
+
 def get_base():
     return _base
 
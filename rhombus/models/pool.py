@@ -0,0 +1,113 @@
+
+# pool.py - connection pool metrics
+
+import bisect
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# upper bounds, in milliseconds, of the buckets of checkout wait time histogram
+wait_buckets = [1, 5, 10, 50, 100, 500, 1000, 5000]
+
+
+class PoolStats(object):
+    """ PoolStats
+
+        Counters of a connection pool, ie. number of checkouts, connections currently
+        checked out and histogram of time spent waiting for a connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkedout = 0
+            self.max_checkedout = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.wait_histogram = [0] * (len(wait_buckets) + 1)
+
+    def record_wait(self, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            self.wait_total += ms
+            self.wait_max = max(self.wait_max, ms)
+            self.wait_histogram[bisect.bisect_left(wait_buckets, ms)] += 1
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checkedout += 1
+            self.max_checkedout = max(self.max_checkedout, self.checkedout)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkedout = max(self.checkedout - 1, 0)
+
+    def as_dict(self):
+        with self._lock:
+            labels = [f'<={b}ms' for b in wait_buckets] + [f'>{wait_buckets[-1]}ms']
+            return dict(
+                connects=self.connects,
+                checkouts=self.checkouts,
+                checkedout=self.checkedout,
+                max_checkedout=self.max_checkedout,
+                wait_total_ms=round(self.wait_total, 3),
+                wait_max_ms=round(self.wait_max, 3),
+                wait_histogram=dict(zip(labels, self.wait_histogram)),
+            )
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records the time spent waiting for a connection """
+
+    pool_stats = None
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.pool_stats is not None:
+                self.pool_stats.record_wait(time.perf_counter() - start_time)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.pool_stats = self.pool_stats
+        return pool
+
+
+def install_pool_stats(engine):
+    """ attach PoolStats to engine pool, and return the PoolStats """
+    stats = PoolStats()
+    event.listen(engine, 'connect', stats.on_connect)
+    event.listen(engine, 'checkout', stats.on_checkout)
+    event.listen(engine, 'checkin', stats.on_checkin)
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.pool_stats = stats
+    engine.pool_stats = stats
+    return stats
+
+
+def pool_status(engine):
+    """ return dictionary of pool status and its PoolStats counters """
+    pool = engine.pool
+    d = dict(pool=pool.__class__.__name__)
+    if isinstance(pool, QueuePool):
+        d.update(size=pool.size(), checkedin=pool.checkedin(), overflow=pool.overflow(),
+                 pool_checkedout=pool.checkedout())
+    if (stats := getattr(engine, 'pool_stats', None)) is not None:
+        d.update(stats.as_dict())
+    return d
+
+# EOF
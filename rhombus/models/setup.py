@@ -44,7 +44,7 @@ def setup(dbh, rootpasswd=None):
         dbsession.commit()
 
     cerr('[initializing EK]')
-    EK.bulk_update(ek_initlist, dbsession=dbsession)
+    EK.bulk_upsert(ek_initlist, dbsession=dbsession)
     dbsession.flush()
 
     Group.bulk_insert(essential_groups, dbsession=dbsession)
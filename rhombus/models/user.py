@@ -10,16 +10,21 @@ Please read the README.txt of this software.
 
 from .core import (registered, Column, types, Base, BaseMixIn, object_session, column_property,
                    ForeignKey, deferred, Identity, relationship, UniqueConstraint, backref,
-                   column_mapped_collection, association_proxy, Table, metadata, and_,
+                   column_mapped_collection, association_proxy, Table, metadata, and_, or_,
                    NoResultFound)
 from .ek import EK
+from .meta import RhoSession
 
 from rhombus.lib.utils import get_dbhandler, cerr
 from rhombus.lib.auth import authfunc
 from rhombus.lib.roles import SYSADM, DATAADM, USERCLASS_MODIFY, USER_MODIFY
 from passlib.hash import sha256_crypt as pwcrypt
 
+from sqlalchemy import event, select, union, bindparam, Index, inspect
+from sqlalchemy.orm import attributes
+
 import yaml
+from itertools import chain
 from pprint import pprint
 
 
@@ -312,23 +317,28 @@ class User(Base, BaseMixIn):
         g_jsoncache.save_data(self)
 
     def groupids(self):
-        """return a list of group_ids where this user is member of"""
-        dbsession = object_session(self)
-        grp_ids = [x[0] for x in dbsession.query(UserGroup.group_id)
-                   .filter(UserGroup.user_id == self.id)]
-        grp_ids2 = [x[0] for x in dbsession.query(AssociatedGroup.group_id)
-                    .filter(AssociatedGroup.assoc_group_id.in_(grp_ids))]
-        return set(grp_ids + grp_ids2)
+        """return a set of group_ids where this user is member of"""
+        return set(self.group_role_ids()[0])
 
     def group_role_ids(self):
-        """return list of (grp_ids, role_ids) on all available groups and roles"""
+        """return (grp_ids, role_ids) as frozensets of all available groups and roles,
+           resolved with a single query and memoized in the session until the membership
+           changes or the transaction ends
+        """
         dbsession = object_session(self)
-        grp_ids = self.groupids()
-        res = dbsession.execute(
-            group_role_table.select(group_role_table.c.group_id.in_(grp_ids))
-            .with_only_columns([group_role_table.c.role_id]).distinct())
-        role_ids = [item for sublist in res.fetchall() for item in sublist]
-        return (grp_ids, role_ids)
+        if (group_roles := dbsession.get_group_roles(self.id)) is not None:
+            return group_roles
+
+        grp_ids = set()
+        role_ids = set()
+        for grp_id, role_id in dbsession.execute(_group_role_stmt(self.id)):
+            grp_ids.add(grp_id)
+            if role_id is not None:
+                role_ids.add(role_id)
+
+        group_roles = (frozenset(grp_ids), frozenset(role_ids))
+        dbsession.set_group_roles(self.id, group_roles)
+        return group_roles
 
     def group_users(self):
         dbsession = object_session(self)
@@ -349,10 +359,11 @@ class User(Base, BaseMixIn):
         return False
 
     def user_instance(self, authhost=None):
+        dbsession = object_session(self)
         group_ids, role_ids = self.group_role_ids()
+        groups, roles = _group_role_pairs(group_ids, role_ids, dbsession)
         return UserInstance(self.login, self.id, self.primarygroup_id,
-                            self.userclass.domain, group_ids, role_ids,
-                            dbsession=object_session(self),
+                            self.userclass.domain, groups, roles,
                             authhost=authhost)
 
     def render(self):
@@ -458,6 +469,22 @@ class User(Base, BaseMixIn):
         yaml.dump_all((x.as_dict() for x in query), out, default_flow_style=False)
 
 
+def _group_role_stmt(user_id):
+    """ return a select statement yielding (group_id, role_id) of all groups where user_id
+        is a member, either directly or through (nested) composite groups, ie. associated
+        groups with role 'C' as recorded in GroupClosure, with role_id as None for groups
+        without any role
+    """
+    direct_groups = select(UserGroup.group_id.label('group_id')).where(
+        UserGroup.user_id == user_id)
+    assoc_groups = select(GroupClosure.ancestor_id.label('group_id')).join(
+        UserGroup, UserGroup.group_id == GroupClosure.descendant_id).where(
+        UserGroup.user_id == user_id)
+    user_groups = union(direct_groups, assoc_groups).cte('user_groups')
+    return select(user_groups.c.group_id, group_role_table.c.role_id).outerjoin(
+        group_role_table, group_role_table.c.group_id == user_groups.c.group_id)
+
+
 def _create_ug_by_user(user):
     return UserGroup(user=user)
 
@@ -495,16 +522,16 @@ class Group(Base, BaseMixIn):
 
     def has_member(self, user):
         if type(user) == int:
+            dbsession = object_session(self)
             if (self.flags & self.f_composite_group):
-                # join UserGroup and AssociatedGroup
-                user_ids = [x[0] for x in
-                            list(AssociatedGroup.get_usergroup_info_query(self, 'C'))]
+                # member of any group nested (at any depth) with role 'C' in this group
+                member_group_ids = select(GroupClosure.descendant_id).where(
+                    GroupClosure.ancestor_id == self.id)
+                criterion = UserGroup.group_id.in_(member_group_ids)
             else:
-                user_ids = [x[0] for x in
-                            object_session(self).query(UserGroup.user_id)
-                            .filter(UserGroup.group_id == self.id)
-                            ]
-            return user in user_ids
+                criterion = UserGroup.group_id == self.id
+            q = UserGroup.query(dbsession).filter(UserGroup.user_id == user, criterion)
+            return dbsession.query(q.exists()).scalar()
 
         elif type(user) == UserInstance:
             return user.in_group(self)
@@ -682,12 +709,14 @@ class UserGroup(Base):
             group = Group.get(group, session)
         ug = UserGroup(user, group, role)
         session.add(ug)
+        session.clear_group_roles()
 
     @staticmethod
     def delete(session, user_id, group_id):
         ug = UserGroup.query(session).filter(UserGroup.user_id == user_id,
                                              UserGroup.group_id == group_id).one()
         session.delete(ug)
+        session.clear_group_roles()
 
 
 @registered
@@ -747,16 +776,20 @@ class AssociatedGroup(Base):
             print('add %d' % grp_id)
             cls.add(group_id, grp_id, role, session)
 
+        session.clear_group_roles()
+
     @classmethod
     def add(cls, group_id, grp_id, role='C', session=None):
 
         if not session:
             session = get_dbhandler().session()
 
-        ag = Group.get(grp_id, session)
-        if (ag.flags & ag.f_composite_group):
+        # composite groups can be nested, as long as they do not form a cycle
+        ancestor_id = group_id.id if isinstance(group_id, Group) else group_id
+        if (role == 'C' and ancestor_id is not None
+                and GroupClosure.contains(grp_id, ancestor_id, session)):
             raise RuntimeError(
-                'Error: composite group cannot consist of another composite group!')
+                'Error: composite group cannot contain itself, either directly or indirectly!')
         if type(group_id) == int:
             ag = cls(group_id=group_id, assoc_group_id=grp_id, role=role)
         elif isinstance(group_id, Group):
@@ -764,11 +797,194 @@ class AssociatedGroup(Base):
         else:
             raise RuntimeError('FATAL PROG/ERR: Need integer or group for 1st argument')
         session.add(ag)
+        session.clear_group_roles()
 
     @classmethod
     def remove(cls, group_id, grp_id, session):
-        ag = cls.query().filter(cls.group_id == group_id, cls.assoc_group_id == grp_id).one()
+        ag = cls.query(session).filter(cls.group_id == group_id,
+                                       cls.assoc_group_id == grp_id).one()
         session.delete(ag)
+        session.clear_group_roles()
+
+
+class GroupClosure(Base):
+    """ materialized transitive closure of composite group containment
+
+        each row states that members of descendant_id are also members of ancestor_id,
+        either directly or through nested composite groups, following only associated
+        groups with role 'C' (composite member); paths is the number of distinct
+        containment paths, so that removing one of several paths keeps the row.
+        This table is maintained by the mapper events of AssociatedGroup, is created and
+        populated by ensure() when the database handler starts, and can be rebuilt with
+        rebuild() (eg. rbmgr --rebuildgroupclosure).
+    """
+
+    __tablename__ = 'group_closures'
+    ancestor_id = Column(types.Integer, ForeignKey('groups.id'), primary_key=True)
+    descendant_id = Column(types.Integer, ForeignKey('groups.id'), primary_key=True)
+    paths = Column(types.Integer, nullable=False, server_default='1')
+
+    __table_args__ = (Index('ix_group_closures_descendant_id', 'descendant_id', 'ancestor_id'),
+                      {})
+
+    @classmethod
+    def contains(cls, ancestor_id, descendant_id, session):
+        """ check whether ancestor_id is, or (indirectly) contains, descendant_id """
+        if ancestor_id == descendant_id:
+            return True
+        return session.query(
+            cls.query(session).filter(cls.ancestor_id == ancestor_id,
+                                      cls.descendant_id == descendant_id).exists()
+        ).scalar()
+
+    @classmethod
+    def link(cls, connection, group_id, assoc_group_id, sign=1):
+        """ add (sign=1) or remove (sign=-1) the containment of assoc_group_id in group_id
+            incrementally, by combining all ancestors of group_id with all descendants of
+            assoc_group_id
+        """
+        t = cls.__table__
+        ancestors = {group_id: 1}
+        ancestors.update(connection.execute(
+            select(t.c.ancestor_id, t.c.paths).where(t.c.descendant_id == group_id)).all())
+        descendants = {assoc_group_id: 1}
+        descendants.update(connection.execute(
+            select(t.c.descendant_id, t.c.paths).where(t.c.ancestor_id == assoc_group_id)).all())
+
+        if sign > 0 and group_id in descendants:
+            raise RuntimeError(
+                'Error: composite group cannot contain itself, either directly or indirectly!')
+
+        existing = {(a, d): p for a, d, p in connection.execute(
+            select(t.c.ancestor_id, t.c.descendant_id, t.c.paths).where(
+                t.c.ancestor_id.in_(list(ancestors)),
+                t.c.descendant_id.in_(list(descendants))))}
+
+        inserts, updates, deletes = [], [], []
+        for a, a_paths in ancestors.items():
+            for d, d_paths in descendants.items():
+                paths = existing.get((a, d), 0) + sign * a_paths * d_paths
+                if (a, d) not in existing:
+                    if paths > 0:
+                        inserts.append(dict(ancestor_id=a, descendant_id=d, paths=paths))
+                elif paths > 0:
+                    updates.append(dict(a_id=a, d_id=d, paths=paths))
+                else:
+                    deletes.append(dict(a_id=a, d_id=d))
+
+        where = and_(t.c.ancestor_id == bindparam('a_id'),
+                     t.c.descendant_id == bindparam('d_id'))
+        if inserts:
+            connection.execute(t.insert(), inserts)
+        if updates:
+            connection.execute(t.update().where(where).values(paths=bindparam('paths')),
+                               updates)
+        if deletes:
+            connection.execute(t.delete().where(where), deletes)
+
+    @classmethod
+    def rebuild(cls, session):
+        """ rebuild the whole closure table from associated_groups, return number of rows """
+        count = cls._rebuild(session)
+        session.clear_group_roles()
+        return count
+
+    @classmethod
+    def ensure(cls, engine):
+        """ create and populate the closure table if it does not exist (eg. in databases
+            created by older versions), or if it is empty while associated groups exist,
+            and return the number of rows inserted
+        """
+        with engine.begin() as conn:
+            inspector = inspect(conn)
+            if not inspector.has_table(AssociatedGroup.__tablename__):
+                return 0
+            if not inspector.has_table(cls.__tablename__):
+                cls.__table__.create(bind=conn)
+            elif conn.execute(select(cls.ancestor_id).limit(1)).first() is not None:
+                return 0
+            if conn.execute(select(AssociatedGroup.id).where(
+                    AssociatedGroup.role == 'C').limit(1)).first() is None:
+                return 0
+            count = cls._rebuild(conn)
+        cerr(f'[Populated group closure table with {count} row(s)]')
+        return count
+
+    @classmethod
+    def _rebuild(cls, conn):
+
+        children = {}
+        for group_id, assoc_group_id in conn.execute(
+                select(AssociatedGroup.group_id, AssociatedGroup.assoc_group_id).where(
+                    AssociatedGroup.role == 'C')):
+            children.setdefault(group_id, []).append(assoc_group_id)
+
+        # descendants[group_id] = {descendant_id: paths}
+        descendants = {}
+
+        def _descendants(group_id, trail):
+            if group_id in descendants:
+                return descendants[group_id]
+            if group_id in trail:
+                raise RuntimeError(f'Error: cycle detected in composite group id {group_id}')
+            trail.add(group_id)
+            res = {}
+            for child_id in children.get(group_id, []):
+                res[child_id] = res.get(child_id, 0) + 1
+                for d, paths in _descendants(child_id, trail).items():
+                    res[d] = res.get(d, 0) + paths
+            trail.discard(group_id)
+            descendants[group_id] = res
+            return res
+
+        rows = []
+        for group_id in children:
+            for d, paths in _descendants(group_id, set()).items():
+                rows.append(dict(ancestor_id=group_id, descendant_id=d, paths=paths))
+
+        t = cls.__table__
+        conn.execute(t.delete())
+        if rows:
+            conn.execute(t.insert(), rows)
+        return len(rows)
+
+
+# only associations with role 'C' (composite member) are recorded in GroupClosure
+
+@event.listens_for(AssociatedGroup, 'after_insert')
+def update_closure_after_insert(mapper, connection, target):
+    if target.role == 'C':
+        GroupClosure.link(connection, target.group_id, target.assoc_group_id, 1)
+
+
+@event.listens_for(AssociatedGroup, 'after_delete')
+def update_closure_after_delete(mapper, connection, target):
+    if target.role == 'C':
+        GroupClosure.link(connection, target.group_id, target.assoc_group_id, -1)
+
+
+@event.listens_for(AssociatedGroup, 'after_update')
+def update_closure_after_update(mapper, connection, target):
+    old, new = [], [target.group_id, target.assoc_group_id, target.role]
+    for i, attr in enumerate(['group_id', 'assoc_group_id', 'role']):
+        hist = attributes.get_history(target, attr)
+        old.append(hist.deleted[0] if hist.deleted else new[i])
+    if old == new:
+        return
+    if old[2] == 'C':
+        GroupClosure.link(connection, old[0], old[1], -1)
+    if new[2] == 'C':
+        GroupClosure.link(connection, new[0], new[1], 1)
+
+
+@event.listens_for(RhoSession, 'after_flush')
+def clear_group_roles_after_flush(session, flush_context):
+    # membership or group roles might have been modified directly through
+    # the relationships, so reset the memoized group & role ids
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (UserGroup, AssociatedGroup, Group)):
+            session.clear_group_roles()
+            break
 
 
 #
@@ -778,30 +994,64 @@ class AssociatedGroup(Base):
 class UserInstance(object):
 
     """ UserInstance is a pickled-able instance that can be transported between processes
+
+        Group and role membership are precomputed as frozensets, so that role and group
+        checks are pure in-memory operations which do not need database access. Only the
+        compact state (see __getstate__) is pickled into the authcache.
     """
 
+    __slots__ = ('login', 'id', 'domain', 'primarygroup_id', 'groups', 'roles',
+                 'laststamp', 'authhost', 'authtoken',
+                 '_role_names', '_group_ids', '_group_names')
+
     def __init__(self, login, id, primarygroup_id, domain=None, groups=None,
                  roles=None, dbsession=None, authhost=None):
         """ login: string, id: int, primarygroup_id: int,
             primarygroup_id: group_id,
-            groups: [ list of group_ids as Group ]
-            roles: [ list of roles_ids as EK ]
+            groups: [ list of (group_name, group_id) ]
+            roles: [ list of (role_key, role_id) ]
+
+            if dbsession is provided, groups and roles are lists of group_ids and role_ids,
+            and the names will be fetched from the database
         """
-        assert dbsession
+        if dbsession is not None:
+            groups, roles = _group_role_pairs(groups, roles, dbsession)
         self.login = login
         self.id = id
         self.domain = domain
         self.primarygroup_id = primarygroup_id
-        self.groups = [(g.name, g.id) for g in [Group.get(gid, dbsession) for gid in groups]]
-        self.roles = [(EK._key(rid, dbsession=dbsession), rid) for rid in roles]
+        self.groups = tuple((name, gid) for (name, gid) in groups or [])
+        self.roles = tuple((key, rid) for (key, rid) in roles or [])
         self.laststamp = -1
         self.authhost = authhost
+        self.authtoken = None
+        self._set_membership()
+
+    def _set_membership(self):
+        self._role_names = frozenset(r[0] for r in self.roles)
+        self._group_ids = frozenset(g[1] for g in self.groups)
+        self._group_names = frozenset(g[0] for g in self.groups)
+
+    def __getstate__(self):
+        return (self.login, self.id, self.domain, self.primarygroup_id, self.groups,
+                self.roles, self.laststamp, self.authhost, self.authtoken)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # userinstance pickled by the previous, non-slotted UserInstance
+            state = (state['login'], state['id'], state.get('domain'),
+                     state['primarygroup_id'], tuple(state['groups']), tuple(state['roles']),
+                     state.get('laststamp', -1), state.get('authhost'),
+                     state.get('authtoken'))
+        (self.login, self.id, self.domain, self.primarygroup_id, self.groups, self.roles,
+         self.laststamp, self.authhost, self.authtoken) = state
+        self._set_membership()
 
     def __str__(self):
         return f"{self.login}/{self.domain}"
 
     def is_sysadm(self):
-        return self.has_roles(SYSADM, DATAADM)
+        return not self._role_names.isdisjoint(_ADMIN_ROLES_)
 
     def is_admin(self, * additional_roles):
         return self.has_roles(* [SYSADM, DATAADM] + list(additional_roles))
@@ -810,36 +1060,31 @@ class UserInstance(object):
         """ check if user at least is in one of the groups """
 
         # if has SYSADM or DATAADM roles, then user is virtually part of any group
-        if self.has_roles(SYSADM, DATAADM):
+        if self.is_sysadm():
             return True
 
         for grp in groups:
             if isinstance(grp, str):
-                grp_id = Group._id(grp)
-                grpname = grp
+                if grp in self._group_names:
+                    return True
             elif isinstance(grp, int):
-                grp_id = grp
-                grpname = Group._name(grp_id, get_dbhandler().session())
+                if grp in self._group_ids:
+                    return True
             elif isinstance(grp, Group):
-                grp_id = grp.id
-                grpname = grp.name
-            elif isinstance(grp, tuple) and grp[1] is None:
-                # force checking by name only:
-                for (grpname, grp_id) in self.groups:
-                    if grpname == grp[0]:
+                if grp.id in self._group_ids:
+                    return True
+            elif isinstance(grp, tuple):
+                # (grpname, None) forces checking by name only
+                if grp[1] is None:
+                    if grp[0] in self._group_names:
                         return True
-            if (grpname, grp_id) in self.groups:
-                return True
+                elif (grp[0], grp[1]) in self.groups:
+                    return True
         return False
 
     def has_roles(self, *roles):
         """ check if user at least has one of the roles """
-        dbsess = get_dbhandler().session()
-        for rolename in roles:
-            role_id = EK._id(rolename, grp='@ROLES', dbsession=dbsess)
-            if (rolename, role_id) in self.roles:
-                return True
-        return False
+        return not self._role_names.isdisjoint(roles)
 
     def get_groups(self, dbsession, system=False):
         """return all groups where this user belongs to"""
@@ -864,6 +1109,23 @@ class UserInstance(object):
                 raise RuntimeError('Group id: %d is not consistent!' % gid)
 
 
+_ADMIN_ROLES_ = frozenset([SYSADM, DATAADM])
+
+
+def _group_role_pairs(group_ids, role_ids, dbsession):
+    """ return ([(group_name, group_id), ...], [(role_key, role_id), ...]) using
+        a single query for each of groups and roles
+    """
+    groups = roles = []
+    if group_ids:
+        groups = [tuple(r) for r in dbsession.query(Group.name, Group.id)
+                  .filter(Group.id.in_(list(group_ids)))]
+    if role_ids:
+        roles = [tuple(r) for r in dbsession.query(EK.key, EK.id)
+                 .filter(EK.id.in_(list(role_ids)))]
+    return groups, roles
+
+
 #
 # globals
 #
@@ -48,6 +48,11 @@ def includeme(config):
         config.add_route('rhombus.dashboard', '/dashboard')
     config.add_view('rhombus.views.dashboard.index', route_name='rhombus.dashboard')
 
+    add_route_view(
+        config, 'rhombus.views.dashboard', 'rhombus.dashboard',
+        ('/dashboard/@@poolstats', 'poolstats', 'json'),
+    )
+
     add_route_view(
         config, 'rhombus.views.group', 'rhombus.group',
         '/group',
@@ -55,6 +60,7 @@ def includeme(config):
         '/group/@@user_action',
         '/group/@@role_action',
         ('/group/@@lookup', 'lookup', 'json'),
+        ('/group/@@datatables', 'datatables', 'json'),
         '/group/{id}@@edit',
         '/group/{id}@@save',
         ('/group/{id}', 'view'),
@@ -65,6 +71,7 @@ def includeme(config):
         '/ek',
         '/ek/@@action',
         ('/ek/@@lookup', 'lookup', 'json'),
+        ('/ek/@@datatables', 'datatables', 'json'),
         '/ek/{id}@@edit',
         '/ek/{id}@@save',
         ('/ek/{id}', 'view'),
@@ -75,6 +82,7 @@ def includeme(config):
         '/userclass',
         '/userclass/@@action',
         '/userclass/@@add',
+        ('/userclass/@@datatables', 'datatables', 'json'),
         '/userclass/{id}@@edit',
         ('/userclass/{id}', 'view'),
     )
@@ -85,6 +93,7 @@ def includeme(config):
         '/user/@@action',
         '/user/@@passwd',
         ('/user/@@lookup', 'lookup', 'json'),
+        ('/user/@@datatables', 'datatables', 'json'),
         '/user/@@add',
         '/user/{id}@@edit',
         # '/user/{id}@@passwd',
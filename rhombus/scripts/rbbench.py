@@ -0,0 +1,497 @@
+
+import sys
+import os
+import time
+import tempfile
+import statistics
+import threading
+import transaction
+
+from sqlalchemy import event
+
+from rhombus.lib.utils import cerr, cout, get_dbhandler, get_dbhandler_class, set_func_userid
+from rhombus.scripts import arg_parser
+
+# rbbench.py
+#
+# micro-benchmarks for rhombus database code paths
+# all benchmarks run against a scratch database, which is a temporary SQLite file
+# unless --url is given, eg:
+#
+#   rhombus-run rbbench --userinstance --groups 1,10,50,100
+#   rhombus-run rbbench --eklookup --ekrows 100000
+#   rhombus-run rbbench --sqliteconcurrency --threads 8 --duration 5
+#   rhombus-run rbbench --datalogger --objects 20000
+#   rhombus-run rbbench --dataloghistory --datalogrows 1000000
+#   rhombus-run rbbench --actionlog --members 1000
+
+
+def init_argparser(parser=None):
+
+    if parser is None:
+        p = arg_parser('rbbench [rhombus]')
+    else:
+        p = parser
+
+    # benchmarks
+
+    p.add_argument('--userinstance', default=False, action='store_true',
+                   help='benchmark User.user_instance() against number of groups')
+    p.add_argument('--eklookup', default=False, action='store_true',
+                   help='benchmark EK lookup latency, ILIKE scan vs indexed exact match')
+    p.add_argument('--sqliteconcurrency', default=False, action='store_true',
+                   help='benchmark concurrent SQLite read/write throughput, default vs WAL pragmas')
+    p.add_argument('--datalogger', default=False, action='store_true',
+                   help='benchmark import throughput with data logger off, per-row and batched')
+    p.add_argument('--dataloghistory', default=False, action='store_true',
+                   help='benchmark object history lookup, with and without data log indexes')
+    p.add_argument('--actionlog', default=False, action='store_true',
+                   help='benchmark ActionLog group fan-out and feed rendering, per-row vs batched')
+
+    # options
+
+    p.add_argument('--url', default='',
+                   help='SQLAlchemy url of scratch database (default: temporary SQLite file)')
+    p.add_argument('--groups', default='1,10,50,100',
+                   help='comma-separated numbers of groups per user')
+    p.add_argument('--ekrows', type=int, default=100000,
+                   help='number of EK rows for --eklookup')
+    p.add_argument('--threads', type=int, default=8,
+                   help='number of reader threads for --sqliteconcurrency')
+    p.add_argument('--duration', type=float, default=5,
+                   help='duration in seconds of each run for --sqliteconcurrency')
+    p.add_argument('--objects', type=int, default=20000,
+                   help='number of objects to import for --datalogger')
+    p.add_argument('--batch', type=int, default=1000,
+                   help='number of objects per flush for --datalogger')
+    p.add_argument('--datalogrows', type=int, default=1000000,
+                   help='number of data log rows for --dataloghistory')
+    p.add_argument('--members', type=int, default=1000,
+                   help='number of group members for --actionlog')
+    p.add_argument('--repeat', type=int, default=20)
+
+    return p
+
+
+def main(args):
+
+    if args.sqliteconcurrency:
+        bench_sqliteconcurrency(args)
+        return
+
+    dbh = prepare_scratch_db(args)
+
+    if args.userinstance:
+        bench_userinstance(args, dbh)
+
+    elif args.eklookup:
+        bench_eklookup(args, dbh)
+
+    elif args.datalogger:
+        bench_datalogger(args, dbh)
+
+    elif args.dataloghistory:
+        bench_dataloghistory(args, dbh)
+
+    elif args.actionlog:
+        bench_actionlog(args, dbh)
+
+    else:
+        cerr('ERR - please provide a benchmark option, see --help')
+
+
+class QueryCounter(object):
+    """ count the number of SQL statements executed by an engine """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def prepare_scratch_db(args):
+
+    if get_dbhandler_class() is None:
+        from rhombus.lib.utils import set_dbhandler_class
+        from rhombus.models.handler import DBHandler
+        set_dbhandler_class(DBHandler)
+
+    url = args.url
+    if not url:
+        url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='rbbench-'), 'bench.sqlite')
+    cerr(f'[rbbench - using scratch database: {url}]')
+
+    set_func_userid(lambda: None)
+    dbh = get_dbhandler({'sqlalchemy.url': url}, initial=True)
+    dbh.initdb(create_table=True, init_data=False)
+
+    from rhombus.models.setup import ek_initlist, essential_groups, system_userclass
+    with transaction.manager:
+        sess = dbh.session()
+        dbh.EK.bulk_update(ek_initlist, dbsession=sess)
+        sess.flush()
+        dbh.Group.bulk_insert(essential_groups, dbsession=sess)
+        dbh.UserClass.bulk_insert(system_userclass, dbsession=sess)
+
+    return dbh
+
+
+def timeit(func, repeat):
+    """ return (mean, stdev) of elapsed time in milliseconds """
+    elapsed = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed.append((time.perf_counter() - t0) * 1000)
+    return statistics.mean(elapsed), statistics.stdev(elapsed) if repeat > 1 else 0.0
+
+
+def bench_userinstance(args, dbh):
+
+    group_counts = [int(x) for x in args.groups.split(',')]
+    role_ids = [r.id for r in dbh.EK.getmembers('@ROLES', dbh.session())]
+    transaction.commit()
+
+    # prepare users with increasing number of groups, each group has 2 roles
+    with transaction.manager:
+        sess = dbh.session()
+        uc = dbh.get_userclass('_SYSTEM_')
+        for n in group_counts:
+            groups = []
+            for i in range(n):
+                g = dbh.Group(name=f'bench-{n}-{i}', desc='')
+                g.roles.extend([dbh.EK.get(role_ids[i % len(role_ids)], sess),
+                                dbh.EK.get(role_ids[(i + 1) % len(role_ids)], sess)])
+                sess.add(g)
+                groups.append(g)
+            sess.flush()
+            uc.add_user(f'bench{n}', 'Bench', f'{n}', f'bench{n}@localhost',
+                        groups[0], [g.name for g in groups[1:]])
+
+    cout('groups\tqueries\tmean_ms\tstdev_ms')
+    for n in group_counts:
+        with transaction.manager:
+            sess = dbh.session()
+            user_id = dbh.get_user(f'bench{n}/_SYSTEM_').id
+
+            def login():
+                # emulate a fresh login, with empty identity map and EK cache
+                sess.expunge_all()
+                sess.clear_keys()
+                dbh.get_user(user_id).user_instance()
+
+            with QueryCounter(dbh.engine) as counter:
+                login()
+            mean, stdev = timeit(login, args.repeat)
+            cout(f'{n}\t{counter.count}\t{mean:.3f}\t{stdev:.3f}')
+
+
+def bench_eklookup(args, dbh):
+
+    from sqlalchemy import func
+    from rhombus.models.ek import get_ek_cache
+
+    EK = dbh.EK
+    groups = 100
+    per_group = max(args.ekrows // groups, 1)
+
+    # populate EK table with core executemany, one parent per group of keys
+    with transaction.manager:
+        sess = dbh.session()
+        parents = [EK(f'@BENCH{g}', f'bench group {g}') for g in range(groups)]
+        sess.add_all(parents)
+        sess.flush()
+        sess.execute(EK.__table__.insert(), [
+            dict(key=f'Key-{g}-{i}', desc='-', syskey=False, member_of_id=p.id,
+                 lastuser_id=None)
+            for g, p in enumerate(parents) for i in range(per_group)
+        ])
+    cerr(f'[rbbench - populated {groups * per_group} EK rows]')
+
+    probes = [(f'key-{(i * 37) % groups}-{(i * 7919) % per_group}', f'@BENCH{(i * 37) % groups}')
+              for i in range(args.repeat)]
+
+    cout('lookup\tmean_ms\tstdev_ms')
+    with transaction.manager:
+        sess = dbh.session()
+        parent_ids = {p: EK._id(p, sess) for p in set(grp for key, grp in probes)}
+
+        def lookup(criterion, with_group):
+            def _lookup():
+                for key, grp in probes:
+                    q = EK.query(sess).filter(criterion(key))
+                    if with_group:
+                        q = q.filter(EK.member_of_id == parent_ids[grp])
+                    q.one()
+            return _lookup
+
+        for label, criterion in [
+                ('ilike', lambda key: EK.key.ilike(key)),
+                ('lower_exact', lambda key: func.lower(EK.key) == key.lower())]:
+            for with_group in [True, False]:
+                mean, stdev = timeit(lookup(criterion, with_group), 3)
+                cout(f'{label}{"" if with_group else "_nogroup"}\t'
+                     f'{mean / len(probes):.3f}\t{stdev / len(probes):.3f}')
+
+        def _id_lookup():
+            get_ek_cache().clear()
+            for key, grp in probes:
+                EK._id(key, sess, grp)
+        mean, stdev = timeit(_id_lookup, 3)
+        cout(f'EK._id\t{mean / len(probes):.3f}\t{stdev / len(probes):.3f}')
+
+
+def bench_datalogger(args, dbh):
+    """ import groups in batches of flushes, with data logger off, with a data logger that
+        inserts one row per mapper event (the former behaviour), with the buffered data
+        logger, and with the out-of-band JSON-lines and SQLite sinks
+    """
+
+    from sqlalchemy import func, select
+    from sqlalchemy.orm import object_session
+    from rhombus.lib.utils import get_userid
+    from rhombus.models import core, meta, datalogsink
+
+    class RowDataLogger(core.DataLogger):
+
+        def append(self, instance, action_id):
+            object_session(instance).connection().execute(
+                core.DataLog.__table__.insert().values(
+                    class_id=instance.__class__.__typeid__, object_id=instance.id,
+                    action_id=action_id, user_id=get_userid()))
+
+    sinkdir = tempfile.mkdtemp(prefix='rbbench-')
+
+    # datalogs column is the cumulative number of rows in datalogs table, or the number
+    # of records written by the sink, which is closed (drained) after timing
+    cout('logger\tobjects\tobjects_per_s\tdatalogs')
+    synced = False
+    for label, logger in [('off', None), ('per_row', RowDataLogger()),
+                          ('batched', core.DataLogger()),
+                          ('jsonl', datalogsink.SinkDataLogger(datalogsink.JSONLinesSink(
+                              os.path.join(sinkdir, 'jsonl')))),
+                          ('sqlite', datalogsink.SinkDataLogger(datalogsink.SQLiteSink(
+                              os.path.join(sinkdir, 'datalogs.sqlite'))))]:
+        if logger is not None:
+            meta.set_datalogger(logger)
+            if not synced:
+                core.get_clsreg().sync()
+                synced = True
+
+        t0 = time.perf_counter()
+        with transaction.manager:
+            sess = dbh.session()
+            for i in range(args.objects):
+                sess.add(dbh.Group(name=f'bench-{label}-{i}', desc=''))
+                if (i + 1) % args.batch == 0:
+                    sess.flush()
+        elapsed = time.perf_counter() - t0
+
+        if isinstance(logger, datalogsink.SinkDataLogger):
+            logger.sink.close()
+            count = logger.sink.written
+        else:
+            with transaction.manager:
+                count = dbh.session().scalar(select(func.count(core.DataLog.id)))
+        cout(f'{label}\t{args.objects}\t{args.objects / elapsed:.1f}\t{count}')
+
+
+def bench_dataloghistory(args, dbh):
+    """ look up history of random objects in a populated datalogs table, with the
+        indexes, and after dropping them (the former schema)
+    """
+
+    import datetime
+    import random
+    from rhombus.models import core, meta
+
+    meta.set_datalogger(core.DataLogger())
+    core.get_clsreg().sync()
+    classes = [dbh.Group, dbh.User, dbh.EK, dbh.UserClass]
+    class_ids = [core.get_clsreg().get_id(cls) for cls in classes]
+    objects = max(args.datalogrows // 20, 1)
+
+    # about 20 data logs per object, spread over 5 years
+    rng = random.Random(0)
+    start = datetime.datetime(2020, 1, 1)
+    table = core.DataLog.__table__
+    chunk = 100000
+    for i in range(0, args.datalogrows, chunk):
+        with dbh.engine.begin() as conn:
+            conn.execute(table.insert(), [
+                dict(stamp=start + datetime.timedelta(seconds=(i + j) * 5 * 365 * 86400
+                                                      // args.datalogrows),
+                     class_id=rng.choice(class_ids), object_id=rng.randrange(objects),
+                     action_id=rng.randint(1, 3), user_id=None)
+                for j in range(min(chunk, args.datalogrows - i))
+            ])
+    cerr(f'[rbbench - populated {args.datalogrows} data log rows]')
+
+    probes = [(rng.choice(classes), rng.randrange(objects)) for i in range(args.repeat)]
+
+    cout('indexes\tmean_ms\tstdev_ms')
+    for label in ['yes', 'no']:
+        if label == 'no':
+            for index in table.indexes:
+                index.drop(bind=dbh.engine)
+        with transaction.manager:
+            sess = dbh.session()
+
+            def lookup():
+                for cls, object_id in probes:
+                    core.DataLog.history(cls, sess, object_id=object_id)
+
+            mean, stdev = timeit(lookup, 3)
+            cout(f'{label}\t{mean / len(probes):.3f}\t{stdev / len(probes):.3f}')
+
+
+def bench_actionlog(args, dbh):
+    """ fan out actionlogs to members of a group, one UserActionLog per member (the former
+        behaviour) vs INSERT ... SELECT, and render a page of the feed of a member, with
+        per-entry User & EK lookups (the former behaviour) vs batched lookups
+    """
+
+    import json
+    from rhombus.models.actionlog import ActionLog, UserActionLog
+
+    with transaction.manager:
+        sess = dbh.session()
+        uc = dbh.get_userclass('_SYSTEM_')
+        group = dbh.Group(name='bench-actionlog', desc='')
+        sess.add(group)
+        sess.flush()
+        group_id = group.id
+        sess.execute(dbh.User.__table__.insert(), [
+            dict(login=f'bench{i}', lastname='Bench', firstname=f'{i}', email=f'bench{i}@localhost',
+                 userclass_id=uc.id, primarygroup_id=group_id, credential='{X}', lastuser_id=None)
+            for i in range(args.members)
+        ])
+        user_ids = sess.scalars(dbh.User.select().with_only_columns(dbh.User.id)
+                                .where(dbh.User.login.like('bench%'))).all()
+        sess.execute(dbh.UserGroup.__table__.insert(), [
+            dict(user_id=user_id, group_id=group_id, role='M') for user_id in user_ids])
+        # actions with two objects, eg. 'added to group %s user %s'
+        action_ids = [ek.id for ek in dbh.EK.getmembers('@ACTIONLOG', sess)
+                      if ek.desc.count('%s') == 2]
+
+    def add_per_row(sess, actionlog):
+        for user_id in sess.scalars(dbh.UserGroup.select().with_only_columns(
+                dbh.UserGroup.user_id).where(dbh.UserGroup.group_id == group_id)):
+            UserActionLog.add(user_id, actionlog.id, dbsession=sess)
+        sess.flush()
+
+    def add_batched(sess, actionlog):
+        UserActionLog.add_group(group_id, actionlog.id, dbsession=sess)
+
+    cout('step\tmethod\tqueries\tmean_ms')
+    for label, fanout in [('per_row', add_per_row), ('batched', add_batched)]:
+        elapsed = []
+        for i in range(args.repeat):
+            with transaction.manager:
+                sess = dbh.session()
+                actionlog = ActionLog.add(action_ids[i % len(action_ids)], 'x', 'y',
+                                          dbsession=sess)
+                actionlog.user_id = user_ids[i % len(user_ids)]
+                sess.flush()
+                with QueryCounter(dbh.engine) as counter:
+                    t0 = time.perf_counter()
+                    fanout(sess, actionlog)
+                    elapsed.append((time.perf_counter() - t0) * 1000)
+        cout(f'fanout\t{label}\t{counter.count}\t{statistics.mean(elapsed):.3f}')
+
+    def render_per_row(sess, useractionlogs):
+        return [str(sess.get(dbh.User, u.actionlog.user_id)) +
+                sess.get(dbh.EK, u.actionlog.action_id).desc[2:] % tuple(json.loads(u.actionlog.objs))
+                for u in useractionlogs]
+
+    def render_batched(sess, useractionlogs):
+        return UserActionLog.feed_messages(useractionlogs, sess)
+
+    for label, render in [('per_row', render_per_row), ('batched', render_batched)]:
+        with transaction.manager:
+            sess = dbh.session()
+
+            def page():
+                sess.expunge_all()
+                return render(sess, UserActionLog.feed(user_ids[0], sess, limit=args.repeat))
+
+            with QueryCounter(dbh.engine) as counter:
+                page()
+            mean, stdev = timeit(page, 5)
+            cout(f'feed\t{label}\t{counter.count}\t{mean:.3f}')
+
+
+def bench_sqliteconcurrency(args):
+    """ run reader threads and a single writer thread against a SQLite file for a fixed
+        duration, for each set of pragmas
+    """
+
+    from sqlalchemy import create_engine, text
+    from rhombus.models.meta import sqlite_pragma_listener
+
+    configs = [
+        ('default', []),
+        ('wal', [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('busy_timeout', '5000'),
+                 ('cache_size', '-20000'), ('temp_store', 'MEMORY')]),
+    ]
+
+    cout('pragmas\treads_per_s\twrites_per_s\terrors')
+    for label, pragmas in configs:
+        path = os.path.join(tempfile.mkdtemp(prefix='rbbench-'), 'bench.sqlite')
+        engine = create_engine('sqlite:///' + path, connect_args={'check_same_thread': False})
+        event.listen(engine, 'connect', sqlite_pragma_listener(pragmas))
+
+        with engine.begin() as conn:
+            conn.execute(text('CREATE TABLE bench (id INTEGER PRIMARY KEY, val TEXT)'))
+            conn.execute(text('INSERT INTO bench (val) VALUES (:val)'),
+                         [{'val': f'value-{i}'} for i in range(10000)])
+
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def worker(func, counter):
+            while not stop.is_set():
+                try:
+                    func()
+                    with lock:
+                        counts[counter] += 1
+                except Exception:
+                    with lock:
+                        counts['errors'] += 1
+
+        def read():
+            with engine.connect() as conn:
+                conn.execute(text('SELECT count(*), max(val) FROM bench WHERE id % 7 = 0')).one()
+
+        def write():
+            with engine.begin() as conn:
+                conn.execute(text('INSERT INTO bench (val) VALUES (:val)'), {'val': 'new'})
+                conn.execute(text('UPDATE bench SET val = :val WHERE id = :id'),
+                             {'val': 'updated', 'id': counts['writes'] % 10000 + 1})
+
+        threads = [threading.Thread(target=worker, args=(read, 'reads'))
+                   for i in range(args.threads)]
+        threads.append(threading.Thread(target=worker, args=(write, 'writes')))
+        for th in threads:
+            th.start()
+        time.sleep(args.duration)
+        stop.set()
+        for th in threads:
+            th.join()
+        engine.dispose()
+
+        cout(f'{label}\t{counts["reads"] / args.duration:.1f}\t'
+             f'{counts["writes"] / args.duration:.1f}\t{counts["errors"]}')
+
+# EOF
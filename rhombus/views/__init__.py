@@ -2,7 +2,7 @@
 import logging
 from pyramid.response import Response, FileIter
 from pyramid.renderers import render_to_response
-from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPFound, HTTPBadRequest
 
 from rhombus import configkeys as ck
 from rhombus.lib.roles import PUBLIC, SYSADM, SYSVIEW, DATAADM, DATAVIEW, GUEST
@@ -10,9 +10,10 @@ from rhombus.lib.utils import get_dbhandler, random_string, cerr, cout
 from rhombus.lib.fileutils import save_file
 from rhombus.views.generics import not_authorized, error_page
 from rhombus.models.fileattach import FileAttachment
+from rhombus.models.meta import set_read_only
 import rhombus.lib.tags as t
 
-from sqlalchemy import select
+from sqlalchemy import select, func, or_
 from sqlalchemy.engine.result import ScalarResult
 import sqlalchemy.exc
 import yaml
@@ -20,6 +21,9 @@ import mimetypes
 import time
 import pathlib
 import urllib.parse
+import json
+import functools
+import transaction
 
 log = logging.getLogger(__name__)
 
@@ -107,6 +111,42 @@ class m_roles(roles):
             return wrapped
 
 
+def read_only(wrapped):
+    """ mark a view function as read-only, ie. the request runs with autoflush off, may
+        read from replicas, and its transaction is doomed so that it is rolled back instead
+        of committed; use below roles() or m_roles() so that any writes during
+        authentication (eg. remote user registration) are still committed
+    """
+
+    @functools.wraps(wrapped)
+    def _read_only_view(*args, **kw):
+        _begin_read_only()
+        return wrapped(*args, **kw)
+
+    return _read_only_view
+
+
+def m_read_only(method):
+    """ mark a viewer method as read-only, like read_only(), only if its name is listed in
+        read_only_methods of the viewer class
+    """
+
+    @functools.wraps(method)
+    def _read_only_method(self, *args, **kw):
+        if method.__name__ in self.read_only_methods:
+            _begin_read_only()
+        return method(self, *args, **kw)
+
+    return _read_only_method
+
+
+def _begin_read_only():
+    dbsession = get_dbhandler().session
+    if not (dbsession.registry.has() and dbsession().has_writes()):
+        set_read_only(True)
+        transaction.doom()
+
+
 class ParseFormError(RuntimeError):
 
     def __init__(self, msg, field):
@@ -136,6 +176,10 @@ class BaseViewer(object):
     # function to fetch instance by id
     fetch_func = None
 
+    # names of index, view, lookup and datatables methods to be run as read-only (see
+    # read_only()), opt-in since subclasses might write within these methods
+    read_only_methods = ()
+
     # routes point to editing & viewing
     edit_route = None
     view_route = None
@@ -154,6 +198,13 @@ class BaseViewer(object):
     #   @ - a file attachment field
     form_fields = {}
 
+    # columns for server-side DataTables listing, as list of (title, column, searchable)
+    # where column is the mapped attribute used for ordering and searching, or None
+    # for non-orderable column, eg:
+    #   [ ('', None, False), ('Username', User.login, True) ]
+    datatables_columns = []
+    datatables_route = None
+
     # additional functions to be invoked
 
     # preupdate and postupdate objects, function signature is func(viewer, object, dict)
@@ -216,6 +267,14 @@ class BaseViewer(object):
     def rpc_helper(self):
         raise NotImplementedError()
 
+    def datatables_select(self):
+        """ return select statement of all objects to be listed by datatables() """
+        return self.dbh.construct_select(self.object_class, None)
+
+    def datatables_rows(self, objs):
+        """ return list of rows, with each row being a list of html-escaped cells """
+        raise NotImplementedError()
+
     # Internal methods
 
     def __init__(self, request):
@@ -233,10 +292,12 @@ class BaseViewer(object):
         self.vars = {}
 
     @m_roles(* accessing_roles)
+    @m_read_only
     def index(self) -> Response:
         return self.index_helper()
 
     @m_roles(* accessing_roles)
+    @m_read_only
     def view(self) -> Response:
         self.obj = self.get_object()
         return self.view_helper()
@@ -263,9 +324,21 @@ class BaseViewer(object):
         return html, jscode
 
     @m_roles(* accessing_roles)
+    @m_read_only
     def lookup(self):
         return self.lookup_helper()
 
+    @m_roles(* accessing_roles)
+    @m_read_only
+    def datatables(self):
+        return datatables_helper(self.request, self.dbh, self.datatables_select(),
+                                 self.datatables_columns, self.datatables_rows)
+
+    def datatables_table(self, table_id, order=1):
+        """ return (html, jscode) of an empty table to be filled by datatables() """
+        return datatables_table(table_id, self.request.route_url(self.datatables_route),
+                                self.datatables_columns, order)
+
     @m_roles(not_roles(GUEST), * accessing_roles)
     def action(self):
 
@@ -597,6 +670,94 @@ def check_stamp(request, obj):
     return True
 
 
+# server-side DataTables processing
+
+def int_param(params, key, default=0):
+    """ return params[key] as integer, or default if it is missing or empty, and raise
+        HTTPBadRequest if it is not an integer
+    """
+    value = params.get(key, '').strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPBadRequest(f'Invalid integer value for parameter {key}')
+
+
+def datatables_helper(request, dbh, stmt, columns, rows_func, maxlength=500):
+    """ return a dictionary for DataTables server-side processing, containing only the
+        page requested by the draw, start, length, search[value] and order[i][...] params
+
+        stmt: select statement of all objects, eg. from dbh.construct_select()
+        columns: list of (title, column, searchable), see BaseViewer.datatables_columns
+        rows_func: function to return list of rows from list of objects
+    """
+
+    params = request.params
+    draw = int_param(params, 'draw', 0)
+    start = max(int_param(params, 'start', 0), 0)
+    length = int_param(params, 'length', 10)
+    if length < 0 or length > maxlength:
+        length = maxlength
+
+    def _count(s):
+        return dbh.scalar(select(func.count()).select_from(s.order_by(None).subquery()))
+
+    records_total = records_filtered = _count(stmt)
+
+    search = params.get('search[value]', '').strip()
+    search_cols = [col for (title, col, searchable) in columns if col is not None and searchable]
+    if search and search_cols:
+        pattern = '%' + (search.replace('\\', '\\\\').replace('%', '\\%')
+                         .replace('_', '\\_')) + '%'
+        stmt = stmt.where(or_(*[col.ilike(pattern, escape='\\') for col in search_cols]))
+        records_filtered = _count(stmt)
+
+    order_by = []
+    for i in range(len(columns)):
+        if (idx := int_param(params, f'order[{i}][column]', None)) is None:
+            break
+        if 0 <= idx < len(columns) and (col := columns[idx][1]) is not None:
+            order_by.append(col.desc() if params.get(f'order[{i}][dir]') == 'desc' else col.asc())
+    order_by.append(stmt.column_descriptions[0]['entity'].id)
+
+    objs = dbh.scalars(stmt.order_by(*order_by).offset(start).limit(length)).unique().all()
+
+    return {
+        'draw': draw,
+        'recordsTotal': records_total,
+        'recordsFiltered': records_filtered,
+        'data': rows_func(objs) if objs else [],
+    }
+
+
+def datatables_table(table_id, url, columns, order=1):
+    """ return (html, jscode) of an empty table with server-side processing DataTable,
+        with columns as in datatables_helper() and order as the initial ordering column
+    """
+
+    html = t.table(class_='table table-condensed table-striped', id=table_id)
+    column_opts = [
+        {'title': title or ' ', 'orderable': col is not None, 'searchable': searchable}
+        for (title, col, searchable) in columns
+    ]
+    jscode = '''
+$(document).ready(function() {
+    $('#%s').DataTable( {
+        serverSide: true,
+        processing: true,
+        ajax: %s,
+        fixedHeader: true,
+        order: [ [%d, "asc"] ],
+        columns: %s
+    } );
+} );
+''' % (table_id, json.dumps(url), order, json.dumps(column_opts))
+
+    return html, jscode
+
+
 # session key handling
 
 def generate_sesskey(user_id, obj_id=None):
@@ -2,7 +2,8 @@
 from pyramid.renderers import render_to_response
 from pyramid.httpexceptions import HTTPForbidden
 
-from rhombus.views import roles
+from rhombus.views import roles, read_only
+from rhombus.lib.utils import get_dbhandler
 from rhombus.lib import roles as r
 from rhombus.lib.tags import ul, div, h1, li, a
 
@@ -38,6 +39,9 @@ def index(request):
     if user.has_roles(r.SYSADM, r.SYSVIEW, r.DATAADM, r.DATAVIEW, r.EK_VIEW):
         ul_list.add(li(a('Enumerated Key management',
                          href=request.route_url('rhombus.ek'))))
+    if user.has_roles(r.SYSADM):
+        ul_list.add(li(a('Connection pool statistics (JSON)',
+                         href=request.route_url('rhombus.dashboard-poolstats'))))
 
     html = div()[
         h1('Rhombus Dashboard'),
@@ -48,4 +52,11 @@ def index(request):
                               {'html': html, },
                               request=request)
 
+
+@roles(r.SYSADM)
+@read_only
+def poolstats(request):
+    """ return JSON of connection pool status & counters of database engines """
+    return get_dbhandler().pool_stats()
+
 # EOF
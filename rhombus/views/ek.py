@@ -4,29 +4,29 @@ from rhombus.lib.modals import popup, modal_delete, modal_error
 from rhombus.lib.roles import PUBLIC, SYSADM, SYSVIEW, EK_VIEW, EK_CREATE, EK_MODIFY, EK_DELETE
 from rhombus.lib.tags import (div, table, thead, tbody, th, tr, td, literal, selection_bar, br, ul, li, a, i,
                               form, POST, GET, fieldset, input_text, input_hidden, input_select, input_password,
-                              submit_bar, h3, p, input_textarea, h2)
-from rhombus.views import get_dbhandler, roles, render_to_response, HTTPFound, Response
+                              submit_bar, h3, p, input_textarea, h2, escape)
+from rhombus.views import (get_dbhandler, roles, render_to_response, HTTPFound, Response,
+                           datatables_helper, datatables_table, read_only, int_param)
 from rhombus.views.generics import error_page
 
 
 @roles(SYSADM, SYSVIEW, EK_VIEW)
+@read_only
 def index(request):
     """ list all non-member/root EnumKey (EK) """
 
-    dbh = get_dbhandler()
-    eks = dbh.EK.query(dbh.session()).filter(dbh.EK.member_of_id == None)
-
-    html, code = format_ektable(eks, request)
+    html, code = datatables_ektable(request)
 
     html = div((h2('Enumerated Key'))).add(html)
 
-    return render_to_response('rhombus:templates/generics/page.mako', {
+    return render_to_response('rhombus:templates/generics/datatables_page.mako', {
         'html': html,
         'code': code
     }, request=request)
 
 
 @roles(SYSADM, SYSVIEW, EK_VIEW)
+@read_only
 def view(request):
     """ view a EnumKey along with its members """
     ek_id = int(request.matchdict.get('id', -1))
@@ -36,16 +36,32 @@ def view(request):
         return error_page(request)
 
     eform = edit_form(ek, dbh, request, readonly=True)
-    html, code = format_ektable(ek.members, request, ek)
+    html, code = datatables_ektable(request, ek)
 
     html = div((h2('Enumerated Key'))).add(eform, br, html)
 
-    return render_to_response('rhombus:templates/generics/page.mako', {
+    return render_to_response('rhombus:templates/generics/datatables_page.mako', {
         'html': html,
         'code': code
     }, request=request)
 
 
+@roles(SYSADM, SYSVIEW, EK_VIEW)
+@read_only
+def datatables(request):
+    """ return JSON of a single page of root EnumKeys, or members of member_of_id,
+        for server-side DataTables
+    """
+
+    dbh = get_dbhandler()
+    EK = dbh.EK
+    member_of_id = int_param(request.params, 'member_of_id', 0) or None
+    stmt = dbh.construct_select(EK, None).where(EK.member_of_id == member_of_id)
+
+    return datatables_helper(request, dbh, stmt, ektable_columns(dbh),
+                             lambda eks: ektable_rows(eks, request))
+
+
 @roles(SYSADM, SYSVIEW, EK_MODIFY, EK_CREATE)
 def edit(request):
     """ edit a EnumKey """
@@ -133,6 +149,7 @@ def parse_form(d, dbh):
 
 
 @roles(SYSADM)
+@read_only
 def lookup(request):
     """ return JSON for autocomplete """
     q = request.params.get('q')
@@ -236,4 +253,43 @@ def format_ektable(eks, request, ek=None):
     return bar.render(ek_table)
 
 
+def ektable_columns(dbh):
+    return [
+        ('', None, False),
+        ('Key', dbh.EK.key, True),
+        ('Description', dbh.EK.desc, True),
+    ]
+
+
+def ektable_rows(eks, request):
+    return [
+        [
+            '<input type="checkbox" name="ek-ids" value="%d">' % ek.id,
+            a('%s' % ek.key, href=request.route_url('rhombus.ek-view', id=ek.id)).r(),
+            escape(ek.desc or ''),
+        ] for ek in eks
+    ]
+
+
+def datatables_ektable(request, ek=None):
+    """ return (html, code) of EnumKey table with server-side processing, listing
+        either root EnumKeys or the members of ek
+    """
+
+    html, code = datatables_table(
+        'ektable',
+        request.route_url('rhombus.ek-datatables', _query={'member_of_id': ek.id} if ek else {}),
+        ektable_columns(get_dbhandler())
+    )
+
+    add_button = ('Add key',
+                  request.route_url('rhombus.ek-edit', id=0,
+                                    _query={'member_of_id': ek.id} if ek else {}))
+
+    bar = selection_bar('ek-ids', action=request.route_url('rhombus.ek-action'),
+                        add=add_button)
+
+    return bar.render(html, code)
+
+
 # EOF
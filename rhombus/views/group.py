@@ -1,6 +1,9 @@
 
 from rhombus.views import (
+    datatables_helper,
+    datatables_table,
     get_dbhandler,
+    read_only,
     HTTPFound,
     render_to_response,
     Response,
@@ -52,23 +55,21 @@ from rhombus.lib.modals import (
     modal_error
 )
 
-from rhombus.models.user import Group
+from rhombus.models.user import Group, UserGroup
 
 from pyramid.renderers import render
 
-from sqlalchemy import exc
+from sqlalchemy import exc, select, func
 
 import json
 
 
 @roles(PUBLIC)
+@read_only
 def index(request):
     """ list groups """
 
-    dbh = get_dbhandler()
-    groups = Group.query(dbh.session())
-
-    html, code = format_grouptable(groups, request)
+    html, code = datatables_grouptable(request)
 
     if request.identity.has_roles(SYSADM, GROUP_CREATE):
 
@@ -90,6 +91,17 @@ def index(request):
 
 
 @roles(PUBLIC)
+@read_only
+def datatables(request):
+    """ return JSON of a single page of groups for server-side DataTables """
+
+    dbh = get_dbhandler()
+    return datatables_helper(request, dbh, dbh.construct_select(Group, None),
+                             grouptable_columns, lambda groups: grouptable_rows(groups, request))
+
+
+@roles(PUBLIC)
+@read_only
 def view(request):
 
     dbh = get_dbhandler()
@@ -423,6 +435,7 @@ def role_action(request):
 
 
 @roles(PUBLIC)
+@read_only
 def lookup(request):
     q = request.params.get('q')
 
@@ -543,6 +556,37 @@ $(document).ready(function() {
     return (T, jscode)
 
 
+grouptable_columns = [
+    ('', None, False),
+    ('Group Name', Group.name, True),
+    ('Members', None, False),
+]
+
+
+def datatables_grouptable(request):
+    """ return (html, code) of group table with server-side processing
+    """
+    return datatables_table('grouptable', request.route_url('rhombus.group-datatables'),
+                            grouptable_columns)
+
+
+def grouptable_rows(groups, request):
+
+    counts = dict(get_dbhandler().execute(
+        select(UserGroup.group_id, func.count(UserGroup.user_id))
+        .where(UserGroup.group_id.in_([g.id for g in groups]))
+        .group_by(UserGroup.group_id)
+    ).all())
+
+    return [
+        [
+            '<input type="checkbox" name="group-ids" value="%d" />' % g.id,
+            a(g.name, href=request.route_url('rhombus.group-view', id=g.id)).r(),
+            counts.get(g.id, 0),
+        ] for g in groups
+    ]
+
+
 def format_roletable(group, request):
 
     role_table = table(class_='table table-condensed table-striped')[
@@ -4,7 +4,7 @@ from pyramid.renderers import render_to_response
 from pyramid.security import remember, forget
 from pyramid.httpexceptions import HTTPFound, HTTPNotFound
 
-from rhombus.views import roles
+from rhombus.views import roles, read_only
 from rhombus.lib.roles import SYSADM, SYSVIEW
 from rhombus.models.user import UserClass, UserInstance
 from rhombus.lib.utils import get_dbhandler, random_string
@@ -145,6 +145,7 @@ def guest_login(request):
     return HTTPFound(location=request.referrer or '/', headers=headers)
 
 
+@read_only
 def confirm(request):
     """ return (status, userinfo) tuple with status as boolen for confirmed (True)
         or unconfirmed (False), and userinfo is a list with the following content:
@@ -18,6 +18,7 @@ from rhombus.views.generics import error_page
 
 import sqlalchemy.exc
 from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager
 
 import urllib.parse
 
@@ -28,6 +29,8 @@ class UserViewer(BaseViewer):
 
     object_class = get_dbhandler().User
     fetch_func = get_dbhandler().get_users_by_ids
+
+    read_only_methods = ('index', 'view', 'lookup', 'datatables')
     edit_route = 'rhombus.user-edit'
     view_route = 'rhombus.user-view'
 
@@ -42,10 +45,25 @@ class UserViewer(BaseViewer):
         'institution': ('rhombus-user-institution', ),
     }
 
+    datatables_columns = [
+        ('', None, False),
+        ('Username', get_dbhandler().User.login, True),
+        ('Userclass/Domain', get_dbhandler().UserClass.domain, True),
+    ]
+    datatables_route = 'rhombus.user-datatables'
+
     def index_helper(self):
 
-        users = self.dbh.get_users()
-        html, jscode = generate_user_table(users, self.request)
+        html, jscode = self.datatables_table('usertable')
+        add_button = (
+            'New user',
+            self.request.route_url('rhombus.user-add')
+        )
+        bar = t.selection_bar(
+            'user-ids', action=self.request.route_url('rhombus.user-action'),
+            add=add_button
+        )
+        html, jscode = bar.render(html, jscode)
 
         return render_to_response('rhombus:templates/generics/datatables_page.mako', {
             'title': 'Users',
@@ -73,6 +91,21 @@ class UserViewer(BaseViewer):
 
         return html, jscode
 
+    def datatables_select(self):
+        User = self.object_class
+        return (super().datatables_select().join(User.userclass)
+                .options(contains_eager(User.userclass)))
+
+    def datatables_rows(self, users):
+        request = self.request
+        return [
+            [
+                '<input type="checkbox" name="user-ids" value="%d">' % u.id,
+                a(u.login, href=request.route_url('rhombus.user-view', id=u.id)).r(),
+                t.escape(u.userclass.domain),
+            ] for u in users
+        ]
+
     def update_object(self, obj, d):
 
         dbh = self.dbh
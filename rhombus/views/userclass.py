@@ -6,12 +6,13 @@ from rhombus.lib.tags import (div, table, thead, tbody, th, tr, td, literal, sel
                               form, POST, GET, fieldset, input_text, input_hidden, input_select, input_password,
                               submit_bar, h2, h3, p, input_textarea)
 from rhombus.views import (BaseViewer, render_to_response, form_submit_bar, ParseFormError, roles, yaml_load,
-                           Response, HTTPFound, boolean_checkbox, behave_editor)
+                           Response, HTTPFound, boolean_checkbox, behave_editor, m_roles)
 from rhombus.lib.modals import modal_delete, popup, modal_error
 
 #from rhombus.views import *
 
 import sqlalchemy.exc
+from sqlalchemy import select, func
 
 import io, yaml
 
@@ -22,6 +23,8 @@ class UserClassViewer(BaseViewer):
 
     object_class = get_dbhandler().UserClass
     fetch_func = get_dbhandler().get_userclasses_by_ids
+
+    read_only_methods = ('index', 'view', 'lookup', 'datatables')
     edit_route = 'rhombus.userclass-edit'
     view_route = 'rhombus.userclass-view'
 
@@ -32,10 +35,22 @@ class UserClassViewer(BaseViewer):
         'credscheme': ('rhombus-userclass_credscheme', yaml_load),
     }
 
+    datatables_columns = [
+        ('', None, False),
+        ('UserClass / Domain', get_dbhandler().UserClass.domain, True),
+        ('Users', None, False),
+    ]
+    datatables_route = 'rhombus.userclass-datatables'
+
     def index_helper(self):
 
-        userclasses = self.dbh.get_userclasses()
-        html, jscode = generate_userclass_table(userclasses, self.request)
+        html, jscode = self.datatables_table('userclasstable')
+        add_button = ('New userclass',
+                      self.request.route_url('rhombus.userclass-add')
+                      )
+        bar = selection_bar('userclass-ids', action=self.request.route_url('rhombus.userclass-action'),
+                            add=add_button)
+        html, jscode = bar.render(html, jscode)
 
         return render_to_response('rhombus:templates/generics/datatables_page.mako', {
             'title': 'Userclasses',
@@ -55,6 +70,27 @@ class UserClassViewer(BaseViewer):
 
         return self.render_edit_form(userclass_html, userclass_jscode)
 
+    @m_roles(* accessing_roles)
+    def datatables(self):
+        return super().datatables()
+
+    def datatables_rows(self, userclasses):
+        request = self.request
+        User = self.dbh.User
+        counts = dict(self.dbh.execute(
+            select(User.userclass_id, func.count(User.id))
+            .where(User.userclass_id.in_([uc.id for uc in userclasses]))
+            .group_by(User.userclass_id)
+        ).all())
+        return [
+            [
+                '<input type="checkbox" name="userclass-ids" value="%d" />' % uc.id,
+                t.escape(uc.domain),
+                a('%d' % counts.get(uc.id, 0),
+                  href=request.route_url('rhombus.userclass-view', id=uc.id)).r(),
+            ] for uc in userclasses
+        ]
+
     def update_object(self, obj, d):
 
         dbh = self.dbh